@@ -0,0 +1,223 @@
+#!/usr/bin/python
+"""backtest.py: Walk-forward backtest of MarketModel sale pricing"""
+__version__ = '3.0'
+__author__ = 'Jason Ansel (jansel@jansel.net)'
+__copyright__ = '(C) 2012-2014. GNU GPL 3.'
+
+import argparse
+import collections
+import csv
+import functools
+import itertools
+import logging
+import multiprocessing
+import numpy
+import time
+
+import marketmodel
+
+log = logging.getLogger(__name__)
+
+DAY = 24 * 3600
+
+# test notes first listed in [start, end) with the model trained on notes
+# resolved by start
+Window = collections.namedtuple('Window', ['start', 'end', 'clf', 'features',
+                                           'sold', 'ask', 'value'])
+
+# windows simulated by run_config, set before the pool forks
+WINDOWS = []
+
+RESULT_FIELDS = ('confidence', 'min_markup', 'max_markup', 'listed', 'sold',
+                 'sell_through', 'markup', 'expected_sell_through')
+
+
+def load_store(args):
+  store = marketmodel.open_trading_history_store()
+  if not args.cached or not len(store):
+    marketmodel.update_trading_history_store(store, args.directory, args.jobs)
+  return store
+
+
+def build_windows(store, train_days=30, step_days=7, retrain=True, clf=None,
+                  jobs=1):
+  """
+  Walk forward over the trading history step_days at a time.  For each step
+  the test notes are those first listed during it, and with retrain a new
+  classifier is fit to the notes of the previous train_days whose outcome
+  was already known at the start of the step.  Without retrain every step
+  uses clf.
+  """
+  first_timestamp = store.column('first_timestamp')
+  if not len(first_timestamp):
+    return []
+  idx = numpy.arange(len(store))
+  sold = (marketmodel.stored_seconds_listed(store, idx) <=
+          marketmodel.SOLD_TIMEOUT_HOURS * 3600)
+  end_of_data = max(store.timestamps or [first_timestamp.max()])
+  resolved = marketmodel.stored_should_include(store, end_of_data)
+  windows = []
+  start = first_timestamp.min() + train_days * DAY
+  while start < end_of_data:
+    end = start + step_days * DAY
+    test_idx = numpy.flatnonzero(resolved & (first_timestamp >= start) &
+                                 (first_timestamp < end))
+    if retrain:
+      train_idx = numpy.flatnonzero(
+          marketmodel.stored_should_include(store, start) &
+          (first_timestamp >= start - train_days * DAY))
+      if len(set(sold[train_idx])) < 2:
+        log.info('skipping window at %d, %d training notes', start,
+                 len(train_idx))
+        start = end
+        continue
+      name, estimator, params = marketmodel.TRAIN_CONFIG
+      clf = marketmodel.make_classifier(estimator, params, jobs)
+      clf.fit(marketmodel.stored_feature_matrix(store, train_idx),
+              sold[train_idx].astype(int))
+      if 'n_jobs' in clf.get_params():
+        clf.set_params(n_jobs=1)
+      log.info('window at %d: trained on %d notes, testing on %d', start,
+               len(train_idx), len(test_idx))
+    if len(test_idx):
+      windows.append(Window(start, end, clf,
+                            marketmodel.stored_feature_matrix(store, test_idx),
+                            sold[test_idx],
+                            numpy.array(store.column('ask')[test_idx]),
+                            numpy.array(store.column('value')[test_idx])))
+    start = end
+  return windows
+
+
+def simulate(window, confidence, min_markup, max_markup, search='grid'):
+  """
+  List every test note of window at the price predict_sale_price chooses.
+  We can only observe sales at the price the note was really listed at, so
+  a listing counts as sold if the note sold within SOLD_TIMEOUT_HOURS and
+  our price is no higher than its real ask.
+  """
+  market_model = marketmodel.MarketModel(window.clf)
+  priced = market_model.predict_sale_prices(
+      [list(features) for features in window.features],
+      confidence=confidence, min_markup=min_markup, max_markup=max_markup,
+      search=search)
+  price = numpy.array([p for p, _ in priced])
+  proba = numpy.array([p for _, p in priced])
+  sold = window.sold & (price <= window.ask + 0.005)
+  return {'listed': len(price),
+          'sold': int(sold.sum()),
+          'markup_sum': float((price / window.value)[sold].sum()),
+          'proba_sum': float(proba.sum())}
+
+
+def summarize(config, totals):
+  confidence, min_markup, max_markup = config
+  listed = totals['listed']
+  sold = totals['sold']
+  return {'confidence': confidence,
+          'min_markup': min_markup,
+          'max_markup': max_markup,
+          'listed': listed,
+          'sold': sold,
+          'sell_through': float(sold) / listed if listed else 0.0,
+          'markup': totals['markup_sum'] / sold if sold else 0.0,
+          'expected_sell_through': (totals['proba_sum'] / listed
+                                    if listed else 0.0)}
+
+
+def run_config(config, search='grid'):
+  """Simulate config = (confidence, min_markup, max_markup) on WINDOWS"""
+  totals = collections.Counter()
+  for window in WINDOWS:
+    totals.update(simulate(window, *config, search=search))
+  return summarize(config, totals)
+
+
+def actual_result(windows):
+  """How the notes did at the prices their sellers really asked"""
+  totals = collections.Counter()
+  for window in windows:
+    totals['listed'] += len(window.sold)
+    totals['sold'] += int(window.sold.sum())
+    totals['markup_sum'] += float(
+        (window.ask / window.value)[window.sold].sum())
+  return summarize(('actual', '', ''), totals)
+
+
+def sweep(windows, configs, jobs=1, search='grid'):
+  """run_config for every config, in a pool of jobs processes"""
+  global WINDOWS
+  WINDOWS = windows
+  fn = functools.partial(run_config, search=search)
+  if jobs <= 1 or len(configs) <= 1:
+    return map(fn, configs)
+  pool = multiprocessing.Pool(jobs)
+  try:
+    return pool.map(fn, configs, chunksize=1)
+  finally:
+    pool.terminate()
+
+
+def print_results(results):
+  row_fmt = '{:>10} {:>10} {:>10} {:>8} {:>8} {:>12} {:>8} {:>10}'
+  print row_fmt.format('confidence', 'min_markup', 'max_markup', 'listed',
+                       'sold', 'sell_through', 'markup', 'expected')
+  for r in results:
+    print row_fmt.format(r['confidence'], r['min_markup'], r['max_markup'],
+                         r['listed'], r['sold'],
+                         '%.4f' % r['sell_through'], '%.4f' % r['markup'],
+                         '%.4f' % r['expected_sell_through'])
+
+
+def main():
+  logging.basicConfig(level=logging.INFO)
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--directory', default='trading_history')
+  parser.add_argument('--cached', action='store_true',
+                      help='use the trading history store without updating')
+  parser.add_argument('--jobs', '-j', type=int,
+                      default=multiprocessing.cpu_count())
+  parser.add_argument('--train-days', type=float, default=30)
+  parser.add_argument('--step-days', type=float, default=7)
+  parser.add_argument('--no-retrain', action='store_true',
+                      help='apply the installed MarketModel to every window')
+  parser.add_argument('--confidence', type=float, nargs='+',
+                      default=[0.3, 0.4, 0.5, 0.6, 0.7])
+  parser.add_argument('--min-markup', type=float, nargs='+',
+                      default=[0.95, 0.98, 1.0])
+  parser.add_argument('--max-markup', type=float, nargs='+',
+                      default=[1.1, 1.25, 1.5])
+  parser.add_argument('--search', choices=('bisect', 'grid'),
+                      default='grid',
+                      help='price search, grid is what SellImperfect uses')
+  parser.add_argument('--csv', help='also write the results to this file')
+  args = parser.parse_args()
+
+  clf = None
+  if args.no_retrain:
+    model = marketmodel.MarketModel.instance()
+    if model is None:
+      parser.error('no market model installed')
+    clf = model.clf
+  store = load_store(args)
+  t0 = time.time()
+  windows = build_windows(store, args.train_days, args.step_days,
+                          not args.no_retrain, clf, args.jobs)
+  log.info('%d windows in %.1fs', len(windows), time.time() - t0)
+  configs = [config for config in itertools.product(
+      args.confidence, args.min_markup, args.max_markup)
+      if config[1] <= config[2]]
+  t0 = time.time()
+  results = sweep(windows, configs, args.jobs, args.search)
+  log.info('%d configs in %.1fs', len(configs), time.time() - t0)
+  results.sort(key=lambda r: (-r['sold'] * r['markup'], -r['sell_through']))
+  print_results([actual_result(windows)] + results)
+  if args.csv:
+    with open(args.csv, 'wb') as fd:
+      writer = csv.DictWriter(fd, RESULT_FIELDS)
+      writer.writeheader()
+      writer.writerows(results)
+
+
+if __name__ == '__main__':
+  main()
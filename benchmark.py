@@ -0,0 +1,447 @@
+#!/usr/bin/python
+"""benchmark.py: Timing reports for the slow parts of lendingclubchecker"""
+__version__ = '3.0'
+__author__ = 'Jason Ansel (jansel@jansel.net)'
+__copyright__ = '(C) 2012-2014. GNU GPL 3.'
+
+import argparse
+import collections
+import csv
+import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+
+timer = timeit.default_timer
+
+# throughput in operations per second and per call latency percentiles in
+# seconds
+Result = collections.namedtuple('Result', ['name', 'ops_per_sec', 'p50',
+                                           'p90', 'p99'])
+
+
+def percentile(sorted_values, fraction):
+  if not sorted_values:
+    return 0.0
+  return sorted_values[min(len(sorted_values) - 1,
+                           int(fraction * len(sorted_values)))]
+
+
+def measure(name, fn, items, repeat=3, units=1):
+  """
+  Call fn(item) for every item, repeat times.  Throughput counts units
+  operations per call over the fastest pass, latency percentiles are over
+  every call of every pass.
+  """
+  latencies = []
+  best = None
+  for _ in xrange(repeat):
+    start = timer()
+    for item in items:
+      t0 = timer()
+      fn(item)
+      latencies.append(timer() - t0)
+    elapsed = timer() - start
+    if best is None or elapsed < best:
+      best = elapsed
+  latencies.sort()
+  return Result(name, len(items) * units / max(best, 1e-9),
+                percentile(latencies, 0.5), percentile(latencies, 0.9),
+                percentile(latencies, 0.99))
+
+
+# modules lcchecker.py may import, cheapest first
+IMPORT_MODULES = ('dateparse', 'usfedhol', 'detailsparser', 'detailsstore',
+                  'mechanize', 'BeautifulSoup', 'parsedatetime', 'numpy',
+                  'sklearn.ensemble', 'sklearn.metrics', 'compactforest',
+                  'notecolumns', 'lendingclub', 'default_strategies',
+                  'marketmodel', 'lcchecker')
+
+IMPORT_TIMER = '''
+import sys, time
+sys.path.insert(0, %r)
+t0 = time.time()
+import %s
+print time.time() - t0
+'''
+
+
+def time_import(module, repeat=3):
+  """Best of repeat cold imports of module, each in a new interpreter"""
+  here = os.path.dirname(os.path.abspath(__file__))
+  best = None
+  for _ in xrange(repeat):
+    try:
+      out = subprocess.check_output(
+          [sys.executable, '-c', IMPORT_TIMER % (here, module)],
+          stderr=open(os.devnull, 'w'))
+    except subprocess.CalledProcessError:
+      return None
+    elapsed = float(out.split()[-1])
+    if best is None or elapsed < best:
+      best = elapsed
+  return best
+
+
+def bench_imports(args):
+  results = []
+  for module in IMPORT_MODULES:
+    elapsed = time_import(module, args.repeat)
+    if elapsed is None:
+      print 'import', module, 'failed'
+    else:
+      results.append(Result('import ' + module, 1.0 / max(elapsed, 1e-9),
+                            elapsed, elapsed, elapsed))
+  return results
+
+
+SNAPSHOT_FIELDS = ('LoanId', 'NoteId', 'OrderId', 'OutstandingPrincipal',
+                   'AccruedInterest', 'Status', 'AskPrice', 'Markup/Discount',
+                   'YTM', 'DaysSinceLastPayment', 'CreditScoreTrend',
+                   'FICO End Range', 'Date/Time Listed', 'NeverLate',
+                   'Loan Class', 'Loan Maturity', 'Original Note Amount',
+                   'Interest Rate', 'Remaining Payments',
+                   'Principal + Interest')
+
+
+def synthetic_snapshot_row(rng, note_id):
+  value = round(rng.uniform(5, 25), 2)
+  ask = round(value * rng.uniform(0.9, 1.1), 2)
+  return {'LoanId': note_id // 10,
+          'NoteId': note_id,
+          'OrderId': note_id % 1000,
+          'OutstandingPrincipal': value,
+          'AccruedInterest': '0.1',
+          'Status': rng.choice(['Issued', 'Current', 'In Grace Period',
+                                'Late (16-30 days)', 'Late (31-120 days)']),
+          'AskPrice': ask,
+          'Markup/Discount': round(ask - value, 2),
+          'YTM': rng.choice(['--', '12.3']),
+          'DaysSinceLastPayment': rng.choice(['null', '3', '25']),
+          'CreditScoreTrend': rng.choice(['UP', 'DOWN', 'FLAT']),
+          'FICO End Range': rng.choice(['499-', '700-704', '745-749']),
+          'Date/Time Listed': '11/07/2013',
+          'NeverLate': rng.choice(['true', 'false']),
+          'Loan Class': 'B3',
+          'Loan Maturity': '36',
+          'Original Note Amount': '25',
+          'Interest Rate': '12.5',
+          'Remaining Payments': '30',
+          'Principal + Interest': value}
+
+
+def write_synthetic_snapshot(filename, rows, seed=0, note_ids=10 ** 8):
+  """
+  A trading inventory snapshot like those in trading_history/, with note ids
+  drawn from 1 to note_ids
+  """
+  rng = random.Random(seed)
+  with open(filename, 'wb') as fd:
+    writer = csv.DictWriter(fd, SNAPSHOT_FIELDS)
+    writer.writeheader()
+    for _ in xrange(rows):
+      writer.writerow(synthetic_snapshot_row(rng, rng.randint(1, note_ids)))
+
+
+def synthetic_features(rows, seed=0):
+  """(feature vectors, sold) decoded from a synthetic snapshot"""
+  import marketmodel
+  import numpy
+  tmpdir = tempfile.mkdtemp()
+  try:
+    filename = os.path.join(tmpdir, '1.csv')
+    write_synthetic_snapshot(filename, rows, seed)
+    note_ids, features = marketmodel.load_inventory_features(filename)
+  finally:
+    shutil.rmtree(tmpdir)
+  # cheaper notes sell more often
+  rng = numpy.random.RandomState(seed)
+  markup = features[:, marketmodel.IDX_MARKUP]
+  sold = (rng.uniform(-10, 10, len(markup)) > markup).astype(int)
+  return features, sold
+
+
+def synthetic_details_page(rng, payments=24):
+  """A note details page with the tables Note.load_details reads"""
+  credit = ''.join('<tr><td>%d-%d</td><td>%02d/15/2013</td></tr>\n' % (
+      700 - 5 * i, 704 - 5 * i, i % 12 + 1) for i in xrange(payments // 2))
+  collection = ('<tr><td>05/01/2014 (x)</td><td>Borrower contacted &amp; '
+                'promised</td></tr><tr><td>\n06/01/2014</td><td><b>Failed'
+                '</b> payment</td></tr>')
+  rows = ['<tr><th>Due Date</th><th>Complete Date</th><th>Amount</th>'
+          '<th>Principal</th><th>Interest</th><th>Status</th><th></th></tr>',
+          '<tr><td>Jun 14, 2014</td><td>--</td><td>$12.00</td><td>--</td>'
+          '<td>--</td><td>Scheduled</td><td></td></tr>']
+  for i in xrange(payments):
+    month = i % 12 + 1
+    rows.append('<tr><td> %02d/14/2013 </td><td>%02d/%02d/2013</td>'
+                '<td>$%.2f</td><td>$%.2f</td><td>$1.50</td>'
+                '<td>Completed - on time</td><td>x</td></tr>\n' % (
+                    month, month, 14 + rng.randint(0, 10),
+                    rng.uniform(10, 15), rng.uniform(5, 10)))
+  return ('<html><head><title>Loan Performance</title></head><body>'
+          '<div class="junk">%s</div>'
+          '<table id="trend-data"><thead></thead>%s</table>'
+          '<table id="lcLoanPerfTable2">%s</table>'
+          '<div id="lcLoanPerf1"><table><tbody>%s</tbody></table></div>'
+          '</body></html>') % ('x' * 2000, credit, collection, ''.join(rows))
+
+
+def synthetic_notes_row(note_id):
+  """A notes.csv row for Note()"""
+  return {'NoteId': str(note_id), 'LoanId': str(note_id // 10),
+          'OrderId': str(note_id % 1000), 'PortfolioName': 'New',
+          'Status': 'Current', 'Accrual': '$0.12',
+          'PrincipalRemaining': '$20.50', 'InterestRate': '12.5%',
+          'Term': '36', 'PaymentsReceivedToDate': '6.0',
+          'Trend': 'FLAT', 'NextPaymentDate': '06/14/2014'}
+
+
+def bench_decode(args):
+  import marketmodel
+  tmpdir = tempfile.mkdtemp()
+  try:
+    filename = os.path.join(tmpdir, '1.csv')
+    write_synthetic_snapshot(filename, args.rows)
+    rows = list(csv.DictReader(open(filename)))
+
+    def iter_inventory(filename):
+      for _ in marketmodel.iter_inventory(filename):
+        pass
+
+    return [measure('load_inventory_row', marketmodel.load_inventory_row,
+                    rows, args.repeat),
+            measure('iter_inventory', iter_inventory, [filename],
+                    args.repeat, units=args.rows),
+            measure('load_inventory_features',
+                    marketmodel.load_inventory_features, [filename],
+                    args.repeat, units=args.rows)]
+  finally:
+    shutil.rmtree(tmpdir)
+
+
+def bench_history(args):
+  """
+  Building the trading history store from scratch, over snapshots that
+  list many of the same notes
+  """
+  import historystore
+  import marketmodel
+  tmpdir = tempfile.mkdtemp()
+  try:
+    rows = args.rows // 10
+    for i in xrange(args.snapshots):
+      write_synthetic_snapshot(
+          os.path.join(tmpdir, '%d.csv' % (1400000000 + 3600 * i)), rows,
+          seed=i, note_ids=2 * rows)
+    store = historystore.TradingHistoryStore(
+        os.path.join(tmpdir, 'store'), marketmodel.FEATURE_DECORERS_NAMES)
+
+    def build(_):
+      store.clear()
+      marketmodel.update_trading_history_store(store, tmpdir)
+
+    return [measure('build_trading_history_store', build, [None],
+                    args.repeat, units=rows * args.snapshots)]
+  finally:
+    shutil.rmtree(tmpdir)
+
+
+def bench_details(args):
+  import lendingclub
+  from BeautifulSoup import BeautifulSoup
+  rng = random.Random(0)
+  pages = [synthetic_details_page(rng) for _ in xrange(args.pages)]
+  tables = [BeautifulSoup(page).find('div', {'id': 'lcLoanPerf1'})
+            for page in pages]
+  results = [measure('extract_details', lendingclub.extract_details, pages,
+                     args.repeat),
+             measure('extract_table', lendingclub.extract_table, tables,
+                     args.repeat)]
+  tmpdir = tempfile.mkdtemp()
+  try:
+    browser = lendingclub.LendingClubBrowser(cache_dir=tmpdir)
+    notes = []
+    for i, page in enumerate(pages):
+      note = lendingclub.Note(synthetic_notes_row(1000 + i),
+                              lendingclub=browser)
+      with open(note.cache_path(), 'wb') as fd:
+        fd.write(page)
+      notes.append(note)
+    load_details = lendingclub.Note.load_details
+    # the first pass parses every page, later ones hit the details store
+    results.append(measure('load_details (parse)', load_details, notes, 1))
+    results.append(measure('load_details (stored)', load_details, notes,
+                           args.repeat))
+  finally:
+    shutil.rmtree(tmpdir)
+  return results
+
+
+def bench_dates(args):
+  import dateparse
+  rng = random.Random(0)
+  strings = []
+  for _ in xrange(args.rows):
+    date = datetime.date(2010, 1, 1) + datetime.timedelta(rng.randint(0, 2000))
+    strings.append(rng.choice([date.strftime('%m/%d/%Y'),
+                               date.strftime('%b %d, %Y'),
+                               '--']))
+
+  def uncached(s):
+    dateparse.cache.clear()
+    dateparse.parsedate(s)
+
+  return [measure('fast_parsedate', dateparse.fast_parsedate, strings,
+                  args.repeat),
+          measure('parsedate (miss)', uncached, strings, args.repeat),
+          measure('parsedate (hit)', dateparse.parsedate, strings,
+                  args.repeat)]
+
+
+def bench_pricing(args):
+  import compactforest
+  import marketmodel
+  import sklearn.ensemble
+  features, sold = synthetic_features(args.rows)
+  clf = sklearn.ensemble.RandomForestClassifier(30, random_state=0)
+  clf.fit(features, sold)
+  model = marketmodel.MarketModel(compactforest.CompactForest.from_sklearn(clf))
+  notes = [list(f) for f in features[:args.pages]]
+  options = dict(confidence=0.4, min_markup=0.98, max_markup=1.25)
+
+  def grid(f):
+    model.predict_sale_price(list(f), search='grid', **options)
+
+  def bisect(f):
+    model.predict_sale_price(list(f), search='bisect', **options)
+
+  def grid_batch(notes):
+    model.predict_sale_prices(notes, search='grid', **options)
+
+  def bisect_batch(notes):
+    model.predict_sale_prices(notes, search='bisect', **options)
+
+  return [measure('sell_proba_features', model.sell_proba_features, notes,
+                  args.repeat),
+          measure('predict_sale_price grid', grid, notes, args.repeat),
+          measure('predict_sale_price bisect', bisect, notes, args.repeat),
+          measure('predict_sale_prices grid', grid_batch, [notes],
+                  args.repeat, units=len(notes)),
+          measure('predict_sale_prices bisect', bisect_batch, [notes],
+                  args.repeat, units=len(notes))]
+
+
+def bench_holidays(args):
+  import usfedhol
+  rng = random.Random(0)
+  first = datetime.date(2000, 1, 1).toordinal()
+  last = datetime.date(2030, 12, 31).toordinal()
+  pairs = []
+  for _ in xrange(args.rows):
+    a = datetime.date.fromordinal(rng.randint(first, last))
+    pairs.append((a, a + datetime.timedelta(rng.randint(0, 14))))
+  return [measure('is_holiday', usfedhol.is_holiday,
+                  [a for a, b in pairs], args.repeat),
+          measure('contains_holiday', lambda p: usfedhol.contains_holiday(*p),
+                  pairs, args.repeat),
+          measure('count_holidays',
+                  lambda p: usfedhol.count_holidays(*zip(*p)), [pairs],
+                  args.repeat, units=len(pairs))]
+
+
+SUITES = {'imports': bench_imports,
+          'decode': bench_decode,
+          'history': bench_history,
+          'details': bench_details,
+          'dates': bench_dates,
+          'pricing': bench_pricing,
+          'holidays': bench_holidays}
+
+
+def print_results(results, baseline=None, threshold=0.2):
+  """
+  Print results, compared to baseline if given, and return the names of
+  the ones that are more than threshold slower than it
+  """
+  regressions = []
+  row_fmt = '{:40} {:>12} {:>10} {:>10} {:>10} {:>8}'
+  print row_fmt.format('benchmark', 'ops/s', 'p50 ms', 'p90 ms', 'p99 ms',
+                       'change' if baseline else '')
+  for r in results:
+    change = ''
+    if baseline and r.name in baseline:
+      ratio = r.ops_per_sec / baseline[r.name]['ops_per_sec']
+      change = '%+.1f%%' % (100.0 * (ratio - 1.0))
+      if ratio < 1.0 - threshold:
+        regressions.append(r.name)
+        change += ' !'
+    print row_fmt.format(r.name, '%.1f' % r.ops_per_sec,
+                         '%.3f' % (1000.0 * r.p50),
+                         '%.3f' % (1000.0 * r.p90),
+                         '%.3f' % (1000.0 * r.p99), change)
+  return regressions
+
+
+def save_baseline(filename, results):
+  with open(filename, 'w') as fd:
+    json.dump({'python': platform.python_version(),
+               'machine': platform.node(),
+               'time': time.time(),
+               'results': dict((r.name, r._asdict()) for r in results)},
+              fd, indent=1, sort_keys=True)
+
+
+def load_baseline(filename):
+  with open(filename) as fd:
+    return json.load(fd)['results']
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('suites', nargs='*',
+                      help='suites to run %s (default all)' % sorted(SUITES))
+  parser.add_argument('--repeat', type=int, default=3,
+                      help='repetitions of each measurement')
+  parser.add_argument('--rows', type=int, default=20000,
+                      help='rows of synthetic data')
+  parser.add_argument('--pages', type=int, default=200,
+                      help='details pages and notes to price')
+  parser.add_argument('--snapshots', type=int, default=20,
+                      help='trading history snapshots')
+  parser.add_argument('--save', metavar='FILE',
+                      help='write the results as a baseline')
+  parser.add_argument('--compare', metavar='FILE',
+                      help='compare against a baseline saved with --save')
+  parser.add_argument('--threshold', type=float, default=0.2,
+                      help='fail when throughput drops by more than this '
+                           'fraction of the baseline (default 0.2)')
+  args = parser.parse_args()
+  baseline = load_baseline(args.compare) if args.compare else None
+  results = []
+  regressions = []
+  for name in args.suites or sorted(SUITES):
+    print
+    print '==', name
+    suite_results = [Result(name + '.' + r.name, *r[1:])
+                     for r in SUITES[name](args)]
+    regressions += print_results(suite_results, baseline, args.threshold)
+    results += suite_results
+  if args.save:
+    save_baseline(args.save, results)
+  if regressions:
+    print
+    print 'FAILED: %d benchmarks regressed by more than %.0f%%: %s' % (
+        len(regressions), 100.0 * args.threshold, ', '.join(regressions))
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+  main()
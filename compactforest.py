@@ -0,0 +1,158 @@
+#!/usr/bin/python
+"""compactforest.py: Fast loading export of a sklearn random forest"""
+__version__ = '3.0'
+__author__ = 'Jason Ansel (jansel@jansel.net)'
+__copyright__ = '(C) 2012-2014. GNU GPL 3.'
+
+import json
+import logging
+import numpy
+import os
+
+log = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+ARRAYS = ('left', 'right', 'feature', 'threshold', 'leaf_proba', 'roots')
+
+
+def tree_depth(children_left, children_right):
+  depth = 0
+  level = [0]
+  while level:
+    level = [child for node in level
+             for child in (children_left[node], children_right[node])
+             if child != -1]
+    if level:
+      depth += 1
+  return depth
+
+
+class CompactForest(object):
+  """
+  The trees of a RandomForestClassifier flattened into contiguous arrays.
+  Node ids are global across trees and leaves are their own children, so
+  every sample can take max_depth steps without checking for leaves.
+  predict_proba gives the same results as the forest it was exported from.
+  """
+
+  def __init__(self, left, right, feature, threshold, leaf_proba, roots,
+               classes, max_depth):
+    # plain ndarray views of memory maps index faster than numpy.memmap
+    self.left = numpy.asarray(left)
+    self.right = numpy.asarray(right)
+    self.feature = numpy.asarray(feature)
+    self.threshold = numpy.asarray(threshold)
+    self.leaf_proba = numpy.asarray(leaf_proba)
+    self.roots = numpy.asarray(roots)
+    self.classes_ = numpy.asarray(classes)
+    self.n_estimators = len(roots)
+    self.max_depth = max_depth
+
+  @classmethod
+  def from_sklearn(cls, forest):
+    left = []
+    right = []
+    feature = []
+    threshold = []
+    leaf_proba = []
+    roots = []
+    offset = 0
+    max_depth = 0
+    for estimator in forest.estimators_:
+      tree = estimator.tree_
+      is_leaf = tree.children_left == -1
+      ids = numpy.arange(offset, offset + tree.node_count)
+      left.append(numpy.where(is_leaf, ids, tree.children_left + offset))
+      right.append(numpy.where(is_leaf, ids, tree.children_right + offset))
+      feature.append(numpy.where(is_leaf, 0, tree.feature))
+      threshold.append(tree.threshold)
+      # same normalization as DecisionTreeClassifier.predict_proba
+      proba = numpy.array(tree.value[:, 0, :forest.n_classes_],
+                          dtype=numpy.float64)
+      normalizer = proba.sum(axis=1)[:, numpy.newaxis]
+      normalizer[normalizer == 0.0] = 1.0
+      proba /= normalizer
+      leaf_proba.append(proba)
+      roots.append(offset)
+      offset += tree.node_count
+      max_depth = max(max_depth, tree_depth(tree.children_left,
+                                            tree.children_right))
+    return cls(numpy.concatenate(left).astype(numpy.int32),
+               numpy.concatenate(right).astype(numpy.int32),
+               numpy.concatenate(feature).astype(numpy.int32),
+               numpy.concatenate(threshold).astype(numpy.float64),
+               numpy.concatenate(leaf_proba),
+               numpy.array(roots, dtype=numpy.int32),
+               list(forest.classes_), max_depth)
+
+  def save(self, directory):
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+    for name in ARRAYS:
+      numpy.save(os.path.join(directory, name + '.npy'), getattr(self, name))
+    with open(os.path.join(directory, 'meta.json'), 'w') as fd:
+      json.dump({'version': FORMAT_VERSION,
+                 'classes': self.classes_.tolist(),
+                 'n_estimators': self.n_estimators,
+                 'max_depth': self.max_depth}, fd)
+
+  @classmethod
+  def load(cls, directory, mmap_mode='r'):
+    """Memory maps the arrays, so loading is cheap and pages are shared"""
+    with open(os.path.join(directory, 'meta.json')) as fd:
+      meta = json.load(fd)
+    if meta['version'] != FORMAT_VERSION:
+      raise ValueError('unsupported compact forest version %s in %s' % (
+          meta['version'], directory))
+    arrays = [numpy.load(os.path.join(directory, name + '.npy'),
+                         mmap_mode=mmap_mode) for name in ARRAYS]
+    return cls(*arrays, classes=meta['classes'], max_depth=meta['max_depth'])
+
+  def apply(self, X):
+    """Leaf node ids, shape (n_estimators, n_samples)"""
+    # sklearn trees compare float32 features against float64 thresholds
+    X = numpy.asarray(X, dtype=numpy.float32)
+    n_samples = X.shape[0]
+    nodes = numpy.repeat(self.roots, n_samples)
+    samples = numpy.tile(numpy.arange(n_samples), self.n_estimators)
+    # positions in nodes of (tree, sample) pairs not yet at a leaf
+    active = numpy.arange(len(nodes))
+    for _ in xrange(self.max_depth):
+      node = nodes[active]
+      go_left = X[samples[active], self.feature[node]] <= self.threshold[node]
+      node = numpy.where(go_left, self.left[node], self.right[node])
+      nodes[active] = node
+      active = active[self.left[node] != node]
+      if not len(active):
+        break
+    return nodes.reshape((self.n_estimators, n_samples))
+
+  def predict_proba(self, X):
+    leaves = self.apply(X)
+    proba = numpy.zeros((leaves.shape[1], self.leaf_proba.shape[1]))
+    # sum trees in order, as the forest does, for identical rounding
+    for tree_leaves in leaves:
+      proba += self.leaf_proba[tree_leaves]
+    proba /= self.n_estimators
+    return proba
+
+  def predict(self, X):
+    return self.classes_.take(numpy.argmax(self.predict_proba(X), axis=1))
+
+
+def export(forest, directory):
+  compact = CompactForest.from_sklearn(forest)
+  compact.save(directory)
+  return compact
+
+
+def load(directory):
+  return CompactForest.load(directory)
+
+
+def verify(forest, compact, X):
+  """Returns the largest difference in predict_proba between the two"""
+  if not len(X):
+    return 0.0
+  return float(numpy.abs(forest.predict_proba(X) -
+                         compact.predict_proba(X)).max())
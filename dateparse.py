@@ -0,0 +1,90 @@
+#!/usr/bin/python
+"""dateparse.py: Fast parsing of the date formats used by lendingclub.com"""
+__version__ = '3.0'
+__author__ = 'Jason Ansel (jansel@jansel.net)'
+__copyright__ = '(C) 2012-2014. GNU GPL 3.'
+
+import collections
+import datetime
+import re
+
+MAX_CACHE_SIZE = 4096
+
+MONTHS = {}
+for _n, _name in enumerate(('january', 'february', 'march', 'april', 'may',
+                            'june', 'july', 'august', 'september', 'october',
+                            'november', 'december')):
+  MONTHS[_name] = _n + 1
+  MONTHS[_name[:3]] = _n + 1
+
+# 05/14/2014
+NUMERIC_RE = re.compile(r'^\s*([0-9]{1,2})/([0-9]{1,2})/([0-9]{4})\s*$')
+# May 14, 2014 or September 14, 2014
+NAMED_RE = re.compile(r'^\s*([A-Za-z]+)\.?\s+([0-9]{1,2}),?\s+([0-9]{4})\s*$')
+
+cache = dict()
+stats = collections.Counter()
+calendar = None
+
+
+def fast_parsedate(s):
+  """Returns a date for the formats we know, otherwise None"""
+  m = NUMERIC_RE.match(s)
+  if m is not None:
+    month, day, year = map(int, m.groups())
+  else:
+    m = NAMED_RE.match(s)
+    if m is None:
+      return None
+    month = MONTHS.get(m.group(1).lower())
+    if month is None:
+      return None
+    day, year = int(m.group(2)), int(m.group(3))
+  try:
+    return datetime.date(year, month, day)
+  except ValueError:
+    return None
+
+
+def slow_parsedate(s):
+  global calendar
+  if calendar is None:
+    try:
+      import parsedatetime.parsedatetime as pdt
+    except ImportError:
+      import parsedatetime as pdt
+    calendar = pdt.Calendar()
+  return datetime.date(*calendar.parse(s)[0][0:3])
+
+
+def parsedate(s):
+  """
+  Parse a date from a lendingclub.com page or csv, '--' is None.  Formats
+  we recognize are memoized, anything else is handed to parsedatetime.
+  """
+  try:
+    rv = cache[s]
+    stats['hits'] += 1
+    return rv
+  except KeyError:
+    stats['misses'] += 1
+  if s == '--':
+    rv = None
+  else:
+    rv = fast_parsedate(s)
+    if rv is None:
+      # parsedatetime results may be relative to today, don't memoize them
+      stats['fallbacks'] += 1
+      return slow_parsedate(s)
+  if len(cache) >= MAX_CACHE_SIZE:
+    cache.clear()
+  cache[s] = rv
+  return rv
+
+
+def cache_info():
+  return {'hits': stats['hits'],
+          'misses': stats['misses'],
+          'fallbacks': stats['fallbacks'],
+          'size': len(cache),
+          'maxsize': MAX_CACHE_SIZE}
@@ -4,34 +4,43 @@ __copyright__ = '(C) 2012-2014. GNU GPL 3.'
 
 from lendingclub import SellStrategy
 import logging
-try:
-  import marketmodel
-except ImportError:
-  marketmodel = None
 
 log = logging.getLogger(__name__)
 
 
 class SellImperfect(SellStrategy):
+  # search='bisect' is faster but assumes the sell probability falls as the
+  # price rises, which is not true of the forest, see predict_sale_price
+  pricing_options = dict(confidence=0.4, min_markup=0.98, max_markup=1.25,
+                         search='grid')
+
   def sale_price(self, note, markup=None):
+    return self.sale_prices([note], markup)[0]
+
+  def sale_prices(self, notes, markup=None):
+    try:
+      import marketmodel  # numpy and sklearn, only needed to price sales
+    except ImportError:
+      marketmodel = None
     if marketmodel is None or marketmodel.MarketModel.instance() is None:
-      return note.par_value() * markup
+      return [note.par_value() * markup for note in notes]
     model = marketmodel.MarketModel.instance()
-    trading_row = note.to_trading_row_format()
-    price = model.predict_sale_price_trading_row(trading_row,
-                                                 confidence=0.4,
-                                                 min_markup=0.98,
-                                                 max_markup=1.25)
-    try:
-      log.info('Sale: %.2f markup=%.2f %s neverlate=%s rate=%s, '
-               'credit_delta=%s sell_proba=%.2f',
-               price, price / note.par_value(), trading_row['Status'],
-               trading_row['NeverLate'], trading_row['Interest Rate'],
-               note.creditdeltamin(),
-               model.sell_proba_trading_row(trading_row, price=price))
-    except Exception:
-      log.exception('Eeek!')
-    return price
+    trading_rows = [note.to_trading_row_format() for note in notes]
+    features = [marketmodel.load_inventory_row(row)[1] for row in trading_rows]
+    prices = []
+    for note, trading_row, (price, proba) in zip(
+        notes, trading_rows,
+        model.predict_sale_prices(features, **self.pricing_options)):
+      try:
+        log.info('Sale: %.2f markup=%.2f %s neverlate=%s rate=%s, '
+                 'credit_delta=%s sell_proba=%.2f',
+                 price, price / note.par_value(), trading_row['Status'],
+                 trading_row['NeverLate'], trading_row['Interest Rate'],
+                 note.creditdeltamin(), proba)
+      except Exception:
+        log.exception('Eeek!')
+      prices.append(price)
+    return prices
 
   def initial_filter(self, note):
     return note.can_sell()
@@ -0,0 +1,334 @@
+#!/usr/bin/python
+"""detailsparser.py: Fast extraction of the tables on note details pages"""
+__version__ = '3.0'
+__author__ = 'Jason Ansel (jansel@jansel.net)'
+__copyright__ = '(C) 2012-2014. GNU GPL 3.'
+
+import bisect
+import HTMLParser
+import os
+import re
+
+# the only parts of the details page Note.load_details uses
+REGIONS = (('table', 'trend-data'),
+           ('table', 'lcLoanPerfTable2'),
+           ('div', 'lcLoanPerf1'))
+
+REGION_START_RE = re.compile(
+    r'''<(table|div)\s[^>]*?(?<=[\s"'])id\s*=\s*["']?'''
+    r'''(trend-data|lcLoanPerfTable2|lcLoanPerf1)(?=["'\s/>])''',
+    re.IGNORECASE)
+
+# BeautifulSoup's rules for which tags implicitly close open ones
+VOID_TAGS = frozenset(('br', 'hr', 'input', 'img', 'meta', 'spacer', 'link',
+                       'frame', 'base', 'col'))
+NESTABLE_TAGS = {'span': [], 'font': [], 'q': [], 'object': [], 'bdo': [],
+                 'sub': [], 'sup': [], 'center': [],
+                 'blockquote': [], 'div': [], 'fieldset': [], 'ins': [],
+                 'del': [],
+                 'ol': [], 'ul': [], 'li': ['ul', 'ol'], 'dl': [],
+                 'dd': ['dl'], 'dt': ['dl'],
+                 'table': [], 'tr': ['table', 'tbody', 'tfoot', 'thead'],
+                 'td': ['tr'], 'th': ['tr'], 'thead': ['table'],
+                 'tbody': ['table'], 'tfoot': ['table']}
+RESET_NESTING_TAGS = frozenset(
+    ('blockquote', 'div', 'fieldset', 'ins', 'del', 'noscript', 'address',
+     'form', 'p', 'pre', 'ol', 'ul', 'li', 'dl', 'dd', 'dt', 'table', 'tr',
+     'td', 'th', 'thead', 'tbody', 'tfoot'))
+
+# tags whose contents BeautifulSoup does not parse like the HTMLParser does
+UNSUPPORTED_TAGS = frozenset(('script', 'style', 'textarea'))
+
+# start of a comment or of an UNSUPPORTED_TAGS element, where REGION_START_RE
+# may match text that is not markup
+OPAQUE_START_RE = re.compile(r'<!--|<(script|style|textarea)(?=[\s/>])',
+                             re.IGNORECASE)
+OPAQUE_END_RES = dict(
+    (tag, re.compile(r'</%s\s*>' % tag, re.IGNORECASE))
+    for tag in UNSUPPORTED_TAGS)
+
+# BeautifulSoup escapes these when converting text nodes to str
+BARE_AMPERSAND_OR_BRACKET = re.compile(
+    r'([<>]|&(?!#\d+;|#x[0-9a-fA-F]+;|\w+;))')
+ENTITIES = {'<': '&lt;', '>': '&gt;', '&': '&amp;'}
+
+
+def escape(text):
+  return BARE_AMPERSAND_OR_BRACKET.sub(lambda m: ENTITIES[m.group(0)], text)
+
+
+class Unsupported(Exception):
+  """Markup the fast path can't guarantee to parse like BeautifulSoup"""
+  pass
+
+
+class RegionDone(Exception):
+  pass
+
+
+class RegionParser(HTMLParser.HTMLParser):
+  """
+  Event based parser for a single region starting at its opening tag.
+  Collects the text of every <td> in every <tr> the same way
+  lendingclub.extract_row does on a BeautifulSoup tree, and stops as soon
+  as the region's closing tag is seen.
+  """
+
+  def __init__(self):
+    HTMLParser.HTMLParser.__init__(self)
+    self.stack = []
+    self.rows = []
+    self.row = None
+    self.cell = None
+    self.text = None
+
+  def end_text(self):
+    if self.text is not None:
+      if self.cell is not None:
+        self.cell.append(escape(''.join(self.text)))
+      self.text = None
+
+  def end_cell(self):
+    if self.cell is not None:
+      s = ' '.join(x.strip() for x in self.cell)
+      self.row.append(re.sub('[ \r\n\t]+', ' ', s))
+      self.cell = None
+
+  def end_row(self):
+    self.end_cell()
+    if self.row is not None:
+      self.rows.append(self.row)
+      self.row = None
+
+  def pop_to(self, index):
+    """Close stack[index] and everything opened inside it"""
+    for tag in reversed(self.stack[index:]):
+      if tag in ('td', 'th'):
+        self.end_cell()
+      elif tag == 'tr':
+        self.end_row()
+    del self.stack[index:]
+    if not self.stack:
+      raise RegionDone()
+
+  def find(self, names):
+    for i in xrange(len(self.stack) - 1, -1, -1):
+      if self.stack[i] in names:
+        return i
+    return None
+
+  def smart_pop(self, tag):
+    """Implicitly close tags before opening tag, as BeautifulSoup does"""
+    triggers = NESTABLE_TAGS.get(tag)
+    for i in xrange(len(self.stack) - 1, -1, -1):
+      if triggers is None and self.stack[i] == tag:
+        self.pop_to(i)
+        return
+      if ((triggers is not None and self.stack[i] in triggers) or
+              (triggers is None and tag in RESET_NESTING_TAGS and
+               self.stack[i] in RESET_NESTING_TAGS)):
+        self.pop_to(i + 1)
+        return
+    if triggers:
+      # BeautifulSoup would keep looking outside of the region
+      raise Unsupported('<%s> outside of %s' % (tag, '/'.join(triggers)))
+
+  def handle_starttag(self, tag, attrs):
+    self.end_text()
+    if tag in UNSUPPORTED_TAGS:
+      raise Unsupported(tag)
+    if tag in VOID_TAGS:
+      return
+    if not self.stack:
+      self.stack.append(tag)
+      return
+    if tag == 'table' and self.find(('tr', 'td', 'th')) is not None:
+      raise Unsupported('nested table')
+    self.smart_pop(tag)
+    self.stack.append(tag)
+    if tag == 'tr':
+      self.row = []
+    elif tag == 'td':
+      self.cell = []
+
+  def handle_startendtag(self, tag, attrs):
+    self.handle_starttag(tag, attrs)
+    if tag not in VOID_TAGS:
+      self.handle_endtag(tag)
+
+  def handle_endtag(self, tag):
+    self.end_text()
+    if tag in VOID_TAGS:
+      return
+    i = self.find((tag,))
+    if i is None:
+      # may close an element enclosing the region, depends on the whole page
+      raise Unsupported('unmatched </%s>' % tag)
+    self.pop_to(i)
+
+  def handle_data(self, data):
+    if self.text is None:
+      self.text = []
+    self.text.append(data)
+
+  def handle_entityref(self, name):
+    self.handle_data('&%s;' % name)
+
+  def handle_charref(self, name):
+    self.handle_data('&#%s;' % name)
+
+  def handle_comment(self, data):
+    self.end_text()
+    if self.cell is not None:
+      self.cell.append('<!--%s-->' % escape(data))
+
+  def handle_decl(self, decl):
+    raise Unsupported('declaration')
+
+  def handle_pi(self, data):
+    raise Unsupported('processing instruction')
+
+  def unknown_decl(self, data):
+    raise Unsupported('declaration')
+
+
+def extract_region_rows(html, start):
+  parser = RegionParser()
+  try:
+    parser.feed(html[start:])
+  except RegionDone:
+    return parser.rows
+  except HTMLParser.HTMLParseError, e:
+    raise Unsupported(str(e))
+  raise Unsupported('region not closed')
+
+
+def opaque_spans(html):
+  """
+  Sorted (start, end) of the comments and UNSUPPORTED_TAGS elements of html,
+  an unterminated one runs to the end of the page
+  """
+  spans = []
+  pos = 0
+  while True:
+    m = OPAQUE_START_RE.search(html, pos)
+    if m is None:
+      return spans
+    if m.group(1) is None:
+      end = html.find('-->', m.end())
+      end = len(html) if end < 0 else end + 3
+    else:
+      end_m = OPAQUE_END_RES[m.group(1).lower()].search(html, m.end())
+      end = len(html) if end_m is None else end_m.end()
+    spans.append((m.start(), end))
+    pos = end
+
+
+def extract_regions(html):
+  """
+  Returns a dict mapping each id in REGIONS to the rows of <td> text found in
+  elements with that id, in document order, or None if the page contains
+  markup that should be handled by BeautifulSoup instead
+  """
+  rv = dict((region_id, []) for tag, region_id in REGIONS)
+  spans = None
+  for m in REGION_START_RE.finditer(html):
+    tag = m.group(1).lower()
+    region_id = m.group(2)
+    if (tag, region_id) not in REGIONS:
+      continue
+    if spans is None:
+      spans = opaque_spans(html)
+    i = bisect.bisect_right(spans, (m.start(), len(html)))
+    if i and spans[i - 1][1] > m.start():
+      return None  # inside a comment or script, not necessarily markup
+    try:
+      rows = extract_region_rows(html, m.start())
+    except Unsupported:
+      return None
+    for row in rows:
+      for cell in row:
+        try:
+          cell.decode('ascii')
+        except UnicodeDecodeError:
+          return None  # BeautifulSoup would re-encode it
+    rv[region_id].extend(rows)
+  return rv
+
+
+TESTDATA_PAGES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'testdata', 'details', '*.html')
+
+
+def soup_regions(soup):
+  """extract_regions computed by lendingclub.extract_rows on a soup"""
+  import lendingclub
+  return dict((region_id, lendingclub.extract_rows(
+      soup.findAll(tag, {'id': region_id}))) for tag, region_id in REGIONS)
+
+
+def main():
+  """
+  Check the fast extractor against BeautifulSoup on the pages in
+  testdata/details and cached details pages, and report the per page
+  speedup.  Exits with status 1 on any mismatch.
+  """
+  import argparse
+  import glob
+  import lendingclub
+  import sys
+  import time
+  from BeautifulSoup import BeautifulSoup
+
+  parser = argparse.ArgumentParser()
+  parser.add_argument('pages', nargs='*',
+                      help='details pages (default testdata/details/*.html '
+                           'and cache/[0-9]*.html)')
+  parser.add_argument('--verbose', '-v', action='store_true',
+                      help='list the pages that fell back to BeautifulSoup')
+  args = parser.parse_args()
+  pages = args.pages or (sorted(glob.glob(TESTDATA_PAGES)) +
+                         glob.glob('cache/[0-9]*.html'))
+
+  slow_time = 0.0
+  fast_time = 0.0
+  region_time = 0.0
+  fallbacks = 0
+  mismatches = 0
+  for filename in pages:
+    html = open(filename, 'rb').read()
+    t0 = time.time()
+    soup = BeautifulSoup(html)
+    slow = (lendingclub.extract_credit_history(soup),
+            lendingclub.extract_collection_log(soup),
+            lendingclub.extract_payment_history(soup))
+    t1 = time.time()
+    fast = lendingclub.extract_details(html)
+    t2 = time.time()
+    regions = extract_regions(html)
+    t3 = time.time()
+    slow_time += t1 - t0
+    fast_time += t2 - t1
+    region_time += t3 - t2
+    if regions is None:
+      fallbacks += 1
+      if args.verbose:
+        print 'fell back', filename
+    if (repr(slow) != repr(fast) or
+            (regions is not None and regions != soup_regions(soup))):
+      mismatches += 1
+      print 'MISMATCH', filename
+  print '%d pages, %d mismatches, %d fell back to BeautifulSoup' % (
+      len(pages), mismatches, fallbacks)
+  if pages and fast_time > 0:
+    print 'BeautifulSoup %.2fms/page, fast %.2fms/page, %.1fx speedup' % (
+        1000.0 * slow_time / len(pages), 1000.0 * fast_time / len(pages),
+        slow_time / fast_time)
+    print 'of which %.2fms/page finding table rows' % (
+        1000.0 * region_time / len(pages))
+  if mismatches:
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,154 @@
+#!/usr/bin/python
+"""detailsstore.py: SQLite cache of records parsed from note details pages"""
+__version__ = '3.0'
+__author__ = 'Jason Ansel (jansel@jansel.net)'
+__copyright__ = '(C) 2012-2014. GNU GPL 3.'
+
+import datetime
+import json
+import logging
+import sqlite3
+import time
+
+log = logging.getLogger(__name__)
+
+# bump when the schema or the extraction logic changes to drop stale rows
+SCHEMA_VERSION = 2
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS pages (
+  note_id INTEGER PRIMARY KEY,
+  page_hash TEXT NOT NULL,
+  updated INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS credit_history (
+  note_id INTEGER NOT NULL,
+  seq INTEGER NOT NULL,
+  date INTEGER,
+  low INTEGER,
+  high INTEGER,
+  PRIMARY KEY (note_id, seq)
+);
+CREATE TABLE IF NOT EXISTS collection_log (
+  note_id INTEGER NOT NULL,
+  seq INTEGER NOT NULL,
+  date INTEGER,
+  msg TEXT,
+  PRIMARY KEY (note_id, seq)
+);
+CREATE TABLE IF NOT EXISTS payment_history (
+  note_id INTEGER NOT NULL,
+  seq INTEGER NOT NULL,
+  due INTEGER,
+  complete INTEGER,
+  status TEXT,
+  amounts TEXT,
+  PRIMARY KEY (note_id, seq)
+);
+'''
+
+TABLES = ('pages', 'credit_history', 'collection_log', 'payment_history')
+
+
+def encode_date(d):
+  if d is None:
+    return None
+  return d.toordinal()
+
+
+def decode_date(n):
+  if n is None:
+    return None
+  return datetime.date.fromordinal(n)
+
+
+class DetailsStore(object):
+  """
+  Records extracted from each note's cached details page, keyed by note_id
+  and the sha1 of the page they were extracted from.  Rows are plain tuples
+  in the argument order of CreditPoint, CollectionLogItem and
+  PaymentHistoryItem.
+  """
+
+  def __init__(self, filename):
+    self.db = sqlite3.connect(filename)
+    self.db.text_factory = str
+    # this is a cache that can be rebuilt from the html, favor speed
+    self.db.execute('PRAGMA synchronous = OFF')
+    version = self.db.execute('PRAGMA user_version').fetchone()[0]
+    if version != SCHEMA_VERSION:
+      log.info('creating note details store %s', filename)
+      for table in TABLES:
+        self.db.execute('DROP TABLE IF EXISTS %s' % table)
+      self.db.execute('PRAGMA user_version = %d' % SCHEMA_VERSION)
+    self.db.executescript(SCHEMA)
+    self.db.commit()
+
+  def get(self, note_id, page_hash):
+    """
+    Returns (credit_history, collection_log, payment_history) rows or None if
+    the page has not been stored or has changed since
+    """
+    row = self.db.execute('SELECT page_hash FROM pages WHERE note_id = ?',
+                          (note_id,)).fetchone()
+    if row is None or row[0] != page_hash:
+      return None
+    credit_history = [
+        (decode_date(date), low, high) for date, low, high in self.db.execute(
+            'SELECT date, low, high FROM credit_history WHERE note_id = ? '
+            'ORDER BY seq', (note_id,))]
+    collection_log = [
+        (decode_date(date), msg) for date, msg in self.db.execute(
+            'SELECT date, msg FROM collection_log WHERE note_id = ? '
+            'ORDER BY seq', (note_id,))]
+    payment_history = [
+        (decode_date(due), decode_date(complete), status,
+         [x.encode('utf-8') for x in json.loads(amounts)])
+        for due, complete, status, amounts in self.db.execute(
+            'SELECT due, complete, status, amounts FROM payment_history '
+            'WHERE note_id = ? ORDER BY seq', (note_id,))]
+    return credit_history, collection_log, payment_history
+
+  def put(self, note_id, page_hash, credit_history, collection_log,
+          payment_history):
+    with self.db:
+      for table in TABLES:
+        self.db.execute('DELETE FROM %s WHERE note_id = ?' % table,
+                        (note_id,))
+      self.db.execute('INSERT INTO pages VALUES (?, ?, ?)',
+                      (note_id, page_hash, int(time.time())))
+      self.db.executemany(
+          'INSERT INTO credit_history VALUES (?, ?, ?, ?, ?)',
+          [(note_id, seq, encode_date(date), low, high)
+           for seq, (date, low, high) in enumerate(credit_history)])
+      self.db.executemany(
+          'INSERT INTO collection_log VALUES (?, ?, ?, ?)',
+          [(note_id, seq, encode_date(date), msg)
+           for seq, (date, msg) in enumerate(collection_log)])
+      self.db.executemany(
+          'INSERT INTO payment_history VALUES (?, ?, ?, ?, ?, ?)',
+          [(note_id, seq, encode_date(due), encode_date(complete), status,
+            json.dumps(amounts))
+           for seq, (due, complete, status, amounts)
+           in enumerate(payment_history)])
+
+  def prune(self, max_age_days):
+    """
+    Delete the records of pages stored more than max_age_days ago, they are
+    extracted again if the page is still cached.  Returns the number of
+    pages pruned.
+    """
+    cutoff = int(time.time() - max_age_days * 24 * 3600)
+    with self.db:
+      for table in TABLES[1:]:
+        self.db.execute('DELETE FROM %s WHERE note_id IN '
+                        '(SELECT note_id FROM pages WHERE updated < ?)' %
+                        table, (cutoff,))
+      count = self.db.execute('DELETE FROM pages WHERE updated < ?',
+                              (cutoff,)).rowcount
+    if count:
+      log.debug('pruned %d pages from the note details store', count)
+    return count
+
+  def close(self):
+    self.db.close()
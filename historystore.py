@@ -0,0 +1,122 @@
+#!/usr/bin/python
+"""historystore.py: Columnar, memory mapped store of trading history"""
+__version__ = '3.0'
+__author__ = 'Jason Ansel (jansel@jansel.net)'
+__copyright__ = '(C) 2012-2014. GNU GPL 3.'
+
+import json
+import logging
+import numpy
+import os
+
+log = logging.getLogger(__name__)
+
+FORMAT_VERSION = 3
+
+# bits of the flags column
+FLAG_ALWAYS_THE_SAME = 1
+
+
+class TradingHistoryStore(object):
+  """
+  One row per note of a trading history, stored as one raw little endian
+  file per column plus meta.json.  Appends write to the end of every column
+  file before updating the row count in meta.json, so a reader only ever
+  maps complete rows.  meta.json also lists the snapshot timestamps merged
+  into the store so far.
+  """
+
+  def __init__(self, directory, feature_names):
+    self.directory = directory
+    self.feature_names = list(feature_names)
+    self.columns = [('note_id', numpy.dtype('<i8'), ()),
+                    ('first_timestamp', numpy.dtype('<i8'), ()),
+                    ('last_timestamp', numpy.dtype('<i8'), ()),
+                    ('flags', numpy.dtype('u1'), ()),
+                    ('ask', numpy.dtype('<f8'), ()),
+                    ('value', numpy.dtype('<f8'), ()),
+                    ('features', numpy.dtype('<f4'),
+                     (len(self.feature_names),))]
+    self.count = 0
+    self.timestamps = []
+    meta = self.read_meta()
+    if (meta is not None and meta.get('version') == FORMAT_VERSION and
+            meta.get('feature_names') == self.feature_names):
+      self.count = meta['count']
+      self.timestamps = meta['timestamps']
+    elif meta is not None:
+      log.info('ignoring incompatible trading history store %s', directory)
+
+  def __len__(self):
+    return self.count
+
+  def path(self, name):
+    return os.path.join(self.directory, name)
+
+  def read_meta(self):
+    try:
+      with open(self.path('meta.json')) as fd:
+        return json.load(fd)
+    except (IOError, ValueError):
+      return None
+
+  def write_meta(self):
+    tmp = self.path('meta.json.tmp')
+    with open(tmp, 'w') as fd:
+      json.dump({'version': FORMAT_VERSION,
+                 'count': self.count,
+                 'timestamps': self.timestamps,
+                 'feature_names': self.feature_names}, fd)
+    os.rename(tmp, self.path('meta.json'))
+
+  def column(self, name, mode='r'):
+    """Memory map of a column, shape (len(self),) + column shape"""
+    for column, dtype, shape in self.columns:
+      if column == name:
+        break
+    else:
+      raise KeyError(name)
+    if self.count == 0:
+      return numpy.zeros((0,) + shape, dtype=dtype)
+    return numpy.memmap(self.path(name + '.bin'), dtype=dtype, mode=mode,
+                        shape=(self.count,) + shape)
+
+  def update(self, name, idx, values):
+    """Overwrite rows idx of a column in place"""
+    if len(idx):
+      column = self.column(name, mode='r+')
+      column[idx] = values
+      column.flush()
+      del column
+
+  def clear(self):
+    if not os.path.isdir(self.directory):
+      os.makedirs(self.directory)
+    self.count = 0
+    self.timestamps = []
+    self.write_meta()
+    for name, dtype, shape in self.columns:
+      open(self.path(name + '.bin'), 'wb').close()
+
+  def append(self, values):
+    """
+    Append rows given a dict mapping every column name to an array, and
+    write meta.json including any changes to self.timestamps
+    """
+    if self.count == 0:
+      timestamps = self.timestamps
+      self.clear()
+      self.timestamps = timestamps
+    n = None
+    for name, dtype, shape in self.columns:
+      array = numpy.ascontiguousarray(values[name], dtype=dtype)
+      assert array.shape[1:] == shape, name
+      assert n is None or len(array) == n, name
+      n = len(array)
+      with open(self.path(name + '.bin'), 'r+b') as fd:
+        # drop anything past count left by an interrupted append
+        fd.truncate(self.count * dtype.itemsize * int(numpy.prod(shape)))
+        fd.seek(0, os.SEEK_END)
+        array.tofile(fd)
+    self.count += n
+    self.write_meta()
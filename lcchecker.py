@@ -5,6 +5,7 @@ __author__ = 'Jason Ansel (jansel@jansel.net)'
 __copyright__ = '(C) 2012-2014. GNU GPL 3.'
 
 import argparse
+import dateparse
 import datetime
 import default_strategies
 import inspect
@@ -12,9 +13,8 @@ import lendingclub
 import logging
 import os
 import re
-import smtplib
+import runstats
 import time
-from email.mime.text import MIMEText
 from settings import login_email
 from settings import smtp_password
 from settings import smtp_server
@@ -33,6 +33,8 @@ except ImportError:
 
 
 def send_email(me, you, subject, body):
+  import smtplib
+  from email.mime.text import MIMEText
   logging.info("sending email '%s' to %s" % (subject, you))
   msg = MIMEText(body)
   msg['Subject'] = subject
@@ -48,18 +50,21 @@ def send_email(me, you, subject, body):
   s.close()
 
 
-def clean_cache_dir(cache_dir):
+def clean_cache_dir(cache_dir, details_store=None, max_age_days=45):
   """
-  delete files older than 45 days in cache dir
+  delete files older than 45 days in cache dir, and records extracted from
+  pages that long ago from details_store
   """
   for name in os.listdir(cache_dir):
     if re.search('[.]html', name):
       path = os.path.join(cache_dir, name)
       st = os.stat(path)
       day_sold = (time.time() - max(st.st_atime, st.st_mtime)) / 3600 / 24
-      if day_sold > 45:
+      if day_sold > max_age_days:
         logging.debug('deleting %s, %.0f days old' % (name, day_sold))
         os.unlink(path)
+  if details_store is not None:
+    details_store.prune(max_age_days)
 
 
 def setup_logging(args):
@@ -81,6 +86,7 @@ def setup_logging(args):
 
 def main(args):
   log_stream = setup_logging(args)
+  runstats.reset()
   sell = []
   buy = []
   possible_actions = {'dedup': None}
@@ -95,38 +101,71 @@ def main(args):
     print "ERROR: Must select one of the following actions"
     print possible_actions.keys()
     return
+  server = None
+  lc = None
   try:
-    lc = lendingclub.LendingClubBrowser()
+    base_url = args.base_url
+    if args.replay:
+      import replay
+      server = replay.ReplayServer(replay.Fixtures(args.replay),
+                                   latency=args.latency,
+                                   error_rate=args.error_rate)
+      base_url = server.start()
+      logging.info('replaying %s from %s', args.replay, base_url)
+    recorder = None
+    if args.record:
+      import replay
+      recorder = replay.Recorder(args.record)
+    lc = lendingclub.LendingClubBrowser(
+        cache_dir=args.cache_dir,
+        concurrency=args.concurrency,
+        max_requests_per_second=args.max_rate,
+        base_url=base_url,
+        recorder=recorder)
     lc.fetch_notes()
     lc.fetch_trading_summary()
     for action in args.actions:
       strategy = possible_actions[action.lower()]
       if strategy is not None:
         strategy = strategy()
-      if isinstance(strategy, lendingclub.SellStrategy):
-        sell += lc.sell_with_strategy(strategy, markup=args.markup,
-                                      fraction=args.fraction)
-      elif isinstance(strategy, lendingclub.BuyTradingStrategy):
-        buy += lc.buy_trading_with_strategy(strategy)
-      elif action.lower() == 'dedup':
-        lc.sell_duplicate_notes(args.markup)
-      else:
-        assert False
+      with runstats.span(action.lower()):
+        if isinstance(strategy, lendingclub.SellStrategy):
+          sell += lc.sell_with_strategy(strategy, markup=args.markup,
+                                        fraction=args.fraction)
+        elif isinstance(strategy, lendingclub.BuyTradingStrategy):
+          buy += lc.buy_trading_with_strategy(strategy)
+        elif action.lower() == 'dedup':
+          lc.sell_duplicate_notes(args.markup)
+        else:
+          assert False
+    lc.mark_notes_processed()
     lc.logout()
-    clean_cache_dir(lc.cache_dir)
+    logging.debug('parsedate cache %s', dateparse.cache_info())
+    with runstats.span('clean_cache_dir'):
+      clean_cache_dir(lc.cache_dir, lc.details_store)
   except KeyboardInterrupt:
     raise
   except:
     logging.exception('unknown error')
   finally:
+    if server is not None:
+      server.stop()
+    runstats.count('sold', len(sell))
+    runstats.count('bought', len(buy))
+    report = runstats.format_report()
+    try:
+      runstats.save(os.path.join(lc.cache_dir if lc else 'cache', 'runs'),
+                    actions=args.actions)
+    except (IOError, OSError):
+      logging.exception('saving run stats')
     log = log_stream.getvalue()
-    print log
+    print log + report
     if log and args.email:
       today = str(datetime.date.today())
       subject = '[LendingClubChecker] buy %d sell %d on %s' % (len(buy),
                                                                len(sell),
                                                                today)
-      send_email(args.emailfrom, args.emailto, subject, log)
+      send_email(args.emailfrom, args.emailto, subject, log + report)
 
 
 if __name__ == '__main__':
@@ -145,5 +184,22 @@ if __name__ == '__main__':
                       help='markup when selling notes (default 0.997)')
   parser.add_argument('--fraction', default=0.2, type=float,
                       help='fraction of notes to check per run (default 0.2)')
+  parser.add_argument('--concurrency', default=4, type=int,
+                      help='parallel note details fetches (default 4)')
+  parser.add_argument('--max-rate', default=2.0, type=float,
+                      help='max requests per second (default 2.0)')
+  parser.add_argument('--cache-dir',
+                      help='directory for downloaded files (default cache/)')
+  parser.add_argument('--base-url',
+                      help='server to use instead of www.lendingclub.com')
+  parser.add_argument('--record', metavar='DIR',
+                      help='save every response as a fixture in DIR')
+  parser.add_argument('--replay', metavar='DIR',
+                      help='serve fixtures recorded in DIR from a local '
+                           'server instead of using lendingclub.com')
+  parser.add_argument('--latency', default=0.0, type=float,
+                      help='seconds of latency added by --replay')
+  parser.add_argument('--error-rate', default=0.0, type=float,
+                      help='fraction of --replay requests failing with 503')
   parser.add_argument('actions', nargs='*', help='List of strategies to run')
   main(parser.parse_args())
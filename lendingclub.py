@@ -9,82 +9,367 @@ import collections
 import csv
 import datetime
 import gzip
+import hashlib
 import json
 import logging
 import math
 import mechanize
 import os
+import Queue
 import random
 import re
 import shutil
+import socket
 import sys
+import threading
 import time
 import urllib
 import urlparse
-from BeautifulSoup import BeautifulSoup
 from pprint import pprint
 from pprint import pformat
 from StringIO import StringIO
 
+import dateparse
+import detailsparser
+import detailsstore
+import runstats
 import usfedhol
 from settings import login_email
 from settings import login_password
 
+log = logging.getLogger(__name__)
 
-try:
-  from mechanize import ParseFile as ClientFormParseFile
-except ImportError:
-  from ClientForm import ParseFile as ClientFormParseFile
+BASE_URL = 'https://www.lendingclub.com'
 
-try:
-  import parsedatetime.parsedatetime as pdt
-except ImportError:
-  import parsedatetime as pdt
 
-log = logging.getLogger(__name__)
+class CircuitOpenError(RuntimeError):
+  pass
+
+
+class RateLimiter(object):
+  """
+  Token bucket shared by every thread making requests to lendingclub.com.
+  The rate is adjusted AIMD style: each healthy response adds increase
+  requests per second (default max_per_second / 10, so the rate climbs from
+  min_per_second to max_per_second in about 10 responses) and each server
+  error multiplies it by decrease (0.75).  With the defaults the rate
+  averages about half of max_per_second while 30% of requests fail, and only
+  nears min_per_second when most requests fail.  A run of consecutive failures opens a
+  circuit breaker that rejects requests for cooldown seconds.
+  """
+
+  def __init__(self, max_per_second, min_per_second=0.2, burst=2.0,
+               increase=None, decrease=0.75, max_backoff=60.0,
+               max_failures=8, cooldown=300.0):
+    assert max_per_second > 0
+    self.max_rate = max_per_second
+    self.min_rate = min(min_per_second, max_per_second)
+    self.rate = max(self.min_rate, max_per_second / 2.0)
+    self.burst = burst
+    self.tokens = burst
+    if increase is None:
+      increase = max_per_second / 10.0
+    self.increase = increase
+    self.decrease = decrease
+    self.max_backoff = max_backoff
+    self.max_failures = max_failures
+    self.cooldown = cooldown
+    self.failures = 0
+    self.open_until = 0.0
+    self.updated = time.time()
+    self.lock = threading.Lock()
+
+  def wait(self):
+    with self.lock:
+      now = time.time()
+      if now < self.open_until:
+        raise CircuitOpenError('%d consecutive request failures, retry in '
+                               '%.0f seconds' % (self.failures,
+                                                 self.open_until - now))
+      self.tokens = min(self.burst,
+                        self.tokens + (now - self.updated) * self.rate)
+      self.updated = now
+      self.tokens -= 1.0
+      delay = max(0.0, -self.tokens / self.rate)
+    if delay > 0:
+      runstats.add_time('rate_limit_sleep', delay)
+      time.sleep(delay)
+
+  def success(self):
+    with self.lock:
+      self.failures = 0
+      self.rate = min(self.max_rate, self.rate + self.increase)
+
+  def failure(self):
+    """
+    Record a failed request, returns seconds to back off before retrying
+    """
+    with self.lock:
+      self.failures += 1
+      self.rate = max(self.min_rate, self.rate * self.decrease)
+      if self.failures >= self.max_failures:
+        log.error('opening circuit breaker after %d failures', self.failures)
+        self.open_until = time.time() + self.cooldown
+      backoff = min(self.max_backoff, 2.0 ** (self.failures - 1))
+    return backoff * random.uniform(0.5, 1.5)
+
+
+class PortfolioIndex(object):
+  """
+  Hash indexes over the notes we own, plus loans we are buying and notes we
+  have listed for sale during this run
+  """
+
+  def __init__(self):
+    self.by_note_id = dict()
+    self.by_loan_id = collections.defaultdict(list)
+    self.by_order_id = collections.defaultdict(list)
+    self.buying_loan_ids = collections.Counter()
+    self.listed_note_ids = set()
+
+  def set_notes(self, notes):
+    self.by_note_id.clear()
+    self.by_loan_id.clear()
+    self.by_order_id.clear()
+    for note in notes:
+      self.add(note)
+
+  def add(self, note):
+    old = self.by_note_id.get(note.note_id)
+    if old is not None:
+      self.by_loan_id[old.loan_id].remove(old)
+      self.by_order_id[old.order_id].remove(old)
+    self.by_note_id[note.note_id] = note
+    self.by_loan_id[note.loan_id].append(note)
+    self.by_order_id[note.order_id].append(note)
+
+  def has_note(self, note_id):
+    return note_id in self.by_note_id
+
+  def get(self, note_id):
+    return self.by_note_id.get(note_id)
+
+  def notes_for_loan(self, loan_id):
+    return self.by_loan_id.get(loan_id, [])
+
+  def notes_for_order(self, order_id):
+    return self.by_order_id.get(order_id, [])
+
+  def add_buying(self, note):
+    self.buying_loan_ids[note.loan_id] += 1
+
+  def add_listed(self, note):
+    self.listed_note_ids.add(note.note_id)
+
+  def loan_id_counts(self, buying_loan_ids=()):
+    """
+    Number of notes owned or being bought in each loan, buying_loan_ids are
+    parsed from tradingacc.html which may or may not include our own buys
+    """
+    counts = collections.Counter(buying_loan_ids)
+    for loan_id, count in self.buying_loan_ids.iteritems():
+      counts[loan_id] = max(counts[loan_id], count)
+    for loan_id, notes in self.by_loan_id.iteritems():
+      if notes:
+        counts[loan_id] += len(notes)
+    return counts
 
 
 class LendingClubBrowser(object):
-  def __init__(self, cache_dir=None):
+  def __init__(self, cache_dir=None, concurrency=4,
+               max_requests_per_second=2.0, base_url=None, recorder=None):
+    """
+    base_url replaces https://www.lendingclub.com, e.g. to point at a
+    replay.ReplayServer, and recorder (a replay.Recorder) is given every
+    response
+    """
     if cache_dir is None:
       cache_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)),
                                'cache')
     self.cache_dir = cache_dir
     if not os.path.isdir(self.cache_dir):
       os.mkdir(self.cache_dir)
+    self.cookiejar = mechanize.CookieJar()
     self.browser = mechanize.Browser()
     self.browser.set_handle_robots(False)
+    self.browser.set_cookiejar(self.cookiejar)
+    self.base_url = (base_url or BASE_URL).rstrip('/')
+    self.recorder = recorder
+    self.concurrency = concurrency
+    self.limiter = RateLimiter(max_requests_per_second)
+    self.timeout = 60.0
+    self.retries = 4
     self.logged_in = False
-    self.notes = None
+    self._notes = None
+    self.columns = None
+    self.delta = None
+    # notes sell_with_strategy has checked, see mark_notes_processed
+    self.checked_note_ids = set()
+    self.index = PortfolioIndex()
+    self.details_store = detailsstore.DetailsStore(
+        os.path.join(self.cache_dir, 'details.sqlite'))
+
+  def new_worker_browser(self):
+    """
+    Create a browser for use in another thread, mechanize is not thread safe
+    so each worker gets a private copy of the session cookies
+    """
+    cookiejar = mechanize.CookieJar()
+    for cookie in self.cookiejar:
+      cookiejar.set_cookie(cookie)
+    browser = mechanize.Browser()
+    browser.set_handle_robots(False)
+    browser.set_cookiejar(cookiejar)
+    return browser
+
+  def request(self, fn, browser=None, retries=None):
+    """
+    Call fn(browser) through the rate limiter, retrying with exponential
+    backoff on 5xx errors and timeouts
+    """
+    if browser is None:
+      browser = self.browser
+    if retries is None:
+      retries = self.retries
+    for attempt in xrange(retries + 1):
+      self.limiter.wait()
+      runstats.count('requests')
+      try:
+        rsp = fn(browser)
+      except mechanize.HTTPError, e:
+        if e.code < 500:
+          self.limiter.success()  # e.g. 304, the server is healthy
+          raise
+        error = e
+      except (mechanize.URLError, socket.error), e:
+        error = e
+      else:
+        self.limiter.success()
+        return rsp
+      backoff = self.limiter.failure()
+      runstats.count('request_errors')
+      if attempt == retries:
+        raise error
+      log.warning('request failed (%s), retrying in %.1f seconds', error,
+                  backoff)
+      runstats.add_time('backoff_sleep', backoff)
+      time.sleep(backoff)
+
+  def url(self, path):
+    return self.base_url + path
+
+  def open(self, url, data=None, browser=None):
+    rsp = self.request(lambda b: b.open(url, data, timeout=self.timeout),
+                       browser)
+    return self.received(url, data, rsp)
+
+  def submit(self):
+    # form submissions are not idempotent, so never retry them
+    request = self.browser.click()
+    rsp = self.request(lambda b: b.open(request), retries=0)
+    return self.received(request, None, rsp)
+
+  def received(self, url, data, rsp):
+    """Count and, when recording, save a response"""
+    runstats.count('pages_fetched')
+    if hasattr(rsp, 'get_data'):
+      runstats.count('bytes_fetched', len(rsp.get_data()))
+    if self.recorder is not None:
+      self.recorder.record(url, data, rsp)
+    return rsp
 
   def login(self):
     if not self.logged_in:
       log.info('logging in as ' + login_email)
-      try:
-        self.browser.open('https://www.lendingclub.com/account/summary.action')
-      except:
-        # Retry exactly once
-        self.browser.open('https://www.lendingclub.com/account/summary.action')
-      self.browser.select_form(nr=0)
-      self.browser['login_email'] = login_email
-      self.browser['login_password'] = login_password
-      rsp = self.browser.submit()
-      open(self.cache_dir + '/summary.html', 'wb').write(rsp.read())
+      with runstats.span('login'):
+        self.open(self.url('/account/summary.action'))
+        self.browser.select_form(nr=0)
+        self.browser['login_email'] = login_email
+        self.browser['login_password'] = login_password
+        rsp = self.submit()
+        open(self.cache_dir + '/summary.html', 'wb').write(rsp.read())
       self.logged_in = True
 
   def logout(self):
     if self.logged_in:
       log.info('logging out')
-      self.browser.open('https://www.lendingclub.com/account/logout.action')
+      with runstats.span('logout'):
+        self.open(self.url('/account/logout.action'))
       self.logged_in = False
 
   def fetch_notes(self):
     self.login()
     log.info('fetching notes list (csv)')
+    with runstats.span('fetch_notes'):
+      data = self.open(
+          self.url('/account/notesRawDataExtended.action')
+      ).read()
     with open(self.cache_dir + '/notes.csv', 'wb') as fd:
-      fd.write(self.browser.open(
-          'https://www.lendingclub.com/account/notesRawDataExtended.action')
-               .read())
+      fd.write(data)
+    self.delta = None
+
+  def notes_delta(self):
+    """
+    NotesDelta between notes.prev.csv, see mark_notes_processed, and
+    notes.csv, all notes are new if there is no previous snapshot.  It is
+    computed once per fetch_notes and shared by every sell strategy.
+    """
+    if self.delta is None:
+      self.delta = diff_notes_csv(self.cache_dir + '/notes.prev.csv',
+                                  self.cache_dir + '/notes.csv')
+      log.info('notes.csv has %d new, %d removed and %d changed notes',
+               len(self.delta.new), len(self.delta.removed),
+               len(self.delta.changed))
+    return self.delta
+
+  def mark_notes_processed(self, note_ids=None):
+    """
+    Advance notes.prev.csv to the current notes.csv for note_ids, default the
+    notes sell_with_strategy checked during this run, and for notes that did
+    not change.  Other new or changed notes keep their old row, or stay out
+    of it, so the next run's notes_delta() still reports them.
+    """
+    if note_ids is None:
+      note_ids = self.checked_note_ids
+    updated = self.notes_delta().updated()
+    prev_filename = self.cache_dir + '/notes.prev.csv'
+    prev = dict()
+    if os.path.exists(prev_filename):
+      with open(prev_filename, 'rb') as fd:
+        for row in csv.DictReader(fd):
+          prev[row.get('NoteId')] = row
+    with open(self.cache_dir + '/notes.csv', 'rb') as fd:
+      reader = csv.DictReader(fd)
+      with open(prev_filename + '.tmp', 'wb') as out:
+        writer = csv.DictWriter(out, reader.fieldnames or [], restval='',
+                                extrasaction='ignore')
+        writer.writeheader()
+        for row in reader:
+          try:
+            note_id = int(row['NoteId'])
+          except (KeyError, TypeError, ValueError):
+            continue
+          if note_id in note_ids or note_id not in updated:
+            writer.writerow(row)
+          elif row['NoteId'] in prev:
+            writer.writerow(prev[row['NoteId']])
+    os.rename(prev_filename + '.tmp', prev_filename)
+    self.delta = None
+
+  @property
+  def notes(self):
+    """
+    The Notes in notes.csv.  After load_note_columns they are only built,
+    from the columns, the first time they are needed.
+    """
+    if self._notes is None and self.columns is not None:
+      self._notes = self.columns.notes()
+      self.index.set_notes(self._notes)
+    return self._notes
+
+  @notes.setter
+  def notes(self, notes):
+    self._notes = notes
 
   def load_notes(self):
     self.notes = list()
@@ -93,26 +378,138 @@ class LendingClubBrowser(object):
         self.notes.append(Note(row, lendingclub=self))
       except:
         log.exception('loading note')
+    self.index.set_notes(self.notes)
     return self.notes
 
+  def load_note_columns(self):
+    """
+    Columnar notes.csv (see notecolumns.py) that only builds Note objects for
+    the rows that are used, None if numpy is not available.  self.notes and
+    self.index are refilled from it the first time self.notes is used.
+    """
+    try:
+      import notecolumns  # needs numpy
+    except ImportError:
+      return None
+    self.columns = notecolumns.NoteColumns.load(
+        self.cache_dir + '/notes.csv',
+        lambda row: Note(row, lendingclub=self))
+    self.notes = None  # rebuilt from the new columns when needed
+    return self.columns
+
   def load_all_details(self):
     for note in self.notes:
       note.load_details()
 
-  def fetch_details(self, note):
+  def fetch_details(self, note, browser=None):
+    """
+    Revalidate the cached details page for note, using the ETag and
+    Last-Modified validators from the last fetch when the server sent them.
+    Returns True if the page changed.
+    """
+    if browser is None:
+      browser = self.browser
     self.login()
     log.debug('fetching note details ' + str(note.note_id))
-    open(note.cache_path(), 'wb').write(
-        self.browser.open(note.details_uri()).read())
+    meta = note.details_meta()
+    headers = dict()
+    if os.path.exists(note.cache_path()):
+      if meta.get('etag'):
+        headers['If-None-Match'] = meta['etag']
+      if meta.get('last_modified'):
+        headers['If-Modified-Since'] = meta['last_modified']
+    try:
+      rsp = self.open(mechanize.Request(note.details_uri(), headers=headers),
+                      browser=browser)
+    except mechanize.HTTPError, e:
+      if e.code != 304:
+        raise
+      log.debug('note details unchanged (304) ' + str(note.note_id))
+      runstats.count('details_not_modified')
+      os.utime(note.cache_path(), None)
+      return False
+    data = rsp.read()
+    info = rsp.info()
+    digest = hashlib.sha1(data).hexdigest()
+    changed = (digest != meta.get('sha1') or
+               not os.path.exists(note.cache_path()))
+    runstats.count('details_changed' if changed else 'details_unchanged')
+    if changed:
+      open(note.cache_path(), 'wb').write(data)
+    else:
+      os.utime(note.cache_path(), None)  # last_updated() is last check time
+    with open(note.meta_path(), 'wb') as fd:
+      json.dump({'sha1': digest,
+                 'etag': info.getheader('ETag'),
+                 'last_modified': info.getheader('Last-Modified')}, fd)
+    return changed
+
+  def iter_fetch_details(self, notes):
+    """
+    Fetch details for notes using a pool of self.concurrency worker threads.
+    Yields (note, exc_info) in the order fetches complete, exc_info is None
+    unless the fetch failed.
+    """
+    notes = list(notes)
+    if not notes:
+      return
+    self.login()
+    if self.concurrency <= 1:
+      for note in notes:
+        try:
+          self.fetch_details(note)
+          yield note, None
+        except KeyboardInterrupt:
+          raise
+        except Exception:
+          yield note, sys.exc_info()
+      return
+
+    todo = Queue.Queue()
+    done = Queue.Queue()
+    stop = threading.Event()
+    for note in notes:
+      todo.put(note)
+
+    def worker():
+      browser = self.new_worker_browser()
+      while not stop.is_set():
+        try:
+          note = todo.get_nowait()
+        except Queue.Empty:
+          return
+        try:
+          self.fetch_details(note, browser)
+          done.put((note, None))
+        except Exception:
+          done.put((note, sys.exc_info()))
+
+    for _ in xrange(min(self.concurrency, len(notes))):
+      thread = threading.Thread(target=worker)
+      thread.daemon = True
+      thread.start()
+    try:
+      for _ in xrange(len(notes)):
+        while True:
+          try:
+            # a timeout keeps the main thread responsive to ctrl-c
+            yield done.get(timeout=1)
+            break
+          except Queue.Empty:
+            pass
+    finally:
+      stop.set()
 
   def fetch_trading_summary(self):
     self.login()
     log.info('fetching trading summary')
-    open(self.cache_dir + '/tradingacc.html', 'wb').write(
-        self.browser.open(
-            'https://www.lendingclub.com/foliofn/tradingAccount.action').read())
+    with runstats.span('fetch_trading_summary'):
+      open(self.cache_dir + '/tradingacc.html', 'wb').write(
+          self.open(
+              self.url('/foliofn/tradingAccount.action')).read())
 
   def get_already_selling_ids(self):
+    from BeautifulSoup import BeautifulSoup
     soup = BeautifulSoup(open(self.cache_dir + '/tradingacc.html', 'rb'))
     # soup.findAll('table', {'id' : 'purchased-orders'})
     selling = extract_table(soup.findAll('table', {'id': 'loans-1'})[0])
@@ -124,11 +521,13 @@ class LendingClubBrowser(object):
       except:
         return None
 
-    return set(map(getnoteid, selling + sold)) - {None}
+    return (set(map(getnoteid, selling + sold)) - {None} |
+            self.index.listed_note_ids)
 
   def get_buying_loan_ids(self):
     rv = list()
     try:
+      from BeautifulSoup import BeautifulSoup
       soup = BeautifulSoup(open(self.cache_dir + '/tradingacc.html', 'rb'))
       table = soup.findAll('table',
                            {'id': 'purchased-orders'})[0]
@@ -144,17 +543,10 @@ class LendingClubBrowser(object):
     return rv
 
   def get_all_loan_ids(self):
-    buying = self.get_buying_loan_ids()
-    owned = map(lambda x: x.loan_id, self.notes)
-    return set(owned + buying)
+    return set(self.get_loan_id_counts())
 
   def get_loan_id_counts(self):
-    buying = self.get_buying_loan_ids()
-    owned = map(lambda x: x.loan_id, self.notes)
-    counts = collections.Counter()
-    for loan_id in owned + buying:
-      counts[loan_id] += 1
-    return counts
+    return self.index.loan_id_counts(self.get_buying_loan_ids())
 
   def scrape_all_details(self):
     self.fetch_notes()
@@ -212,6 +604,7 @@ class LendingClubBrowser(object):
       log.exception('unhandled error while finding notes that can be sold')
     return set()
 
+  @runstats.timed('sell_notes')
   def sell_notes(self, notes, markup, asking_price_fn=None):
     if asking_price_fn is None:
       asking_price_fn = lambda x_note, x_markup: x_note.par_value() * x_markup
@@ -219,16 +612,16 @@ class LendingClubBrowser(object):
       return
     self.login()
     log.info('selling %d notes' % len(notes))
-    rs = self.browser.open(
-        'https://www.lendingclub.com/foliofn/sellNotes.action')
+    rs = self.open(
+        self.url('/foliofn/sellNotes.action'))
     open(self.cache_dir + '/sell0.html', 'wb').write(rs.read())
 
-    aj_url = ('https://www.lendingclub.com/foliofn/sellNotesAj.action'
-              '?sortBy=nextPayment&dir=desc&startindex=0&pagesize'
-              '=10000&namespace=/foliofn&r={0}&join_criteria=all'
-              '&status_criteria=All&order_ids_criteria=0').format(
-                  random.random())
-    rs = self.browser.open(aj_url)
+    aj_url = self.url('/foliofn/sellNotesAj.action'
+                      '?sortBy=nextPayment&dir=desc&startindex=0&pagesize'
+                      '=10000&namespace=/foliofn&r={0}&join_criteria=all'
+                      '&status_criteria=All&order_ids_criteria=0').format(
+                          random.random())
+    rs = self.open(aj_url)
     # server insists on sending us gziped data for this, extract it...
     open(self.cache_dir + '/sell1.gz', 'wb').write(rs.read())
     try:
@@ -242,10 +635,9 @@ class LendingClubBrowser(object):
       log.warning('error extracting notes list', exc_info=True)
       shutil.copy(self.cache_dir + '/sell1.gz', self.cache_dir + '/sell1.json')
 
-    time.sleep(1.5)  # avoid 503 server errors
-    rs = self.browser.open('https://www.lendingclub.com/foliofn/'
-                           'getSelectedNoteCountAj.action'
-                           '?rnd=%d' % random.randint(0, 999999999))
+    rs = self.open(self.url('/foliofn/'
+                            'getSelectedNoteCountAj.action'
+                            '?rnd=%d' % random.randint(0, 999999999)))
     open(self.cache_dir + '/sell2.html', 'wb').write(rs.read())
 
     can_sell = self.compute_can_sell_ids()  # reads sell1.json
@@ -259,11 +651,10 @@ class LendingClubBrowser(object):
       if note.note_id not in can_sell:
         log.warning('Trying to sell a note that cant be sold %s', note.note_id)
         continue
-      url = ('https://www.lendingclub.com/foliofn/updateLoanCheckBoxAj.action?'
-             'json=[{{%22noteId%22:{},%22remove%22:false}}]&random={}')
-      time.sleep(1.5)  # avoid 503 server errors
-      rs = self.browser.open(url.format(note.note_id,
-                                        random.randint(0, 999999999)))
+      url = self.url('/foliofn/updateLoanCheckBoxAj.action?'
+                     'json=[{{%22noteId%22:{},%22remove%22:false}}]'
+                     '&random={}')
+      rs = self.open(url.format(note.note_id, random.randint(0, 999999999)))
       open(self.cache_dir + '/sell3.html', 'wb').write(rs.read())
       notes_for_sale.append(note)
 
@@ -272,33 +663,37 @@ class LendingClubBrowser(object):
       log.info('nothing for sale')
       return
 
-    time.sleep(1.5)  # avoid 503 server errors
-    rs = self.browser.open(
-        'https://www.lendingclub.com/foliofn/selectLoansForSale.action')
+    rs = self.open(
+        self.url('/foliofn/selectLoansForSale.action'))
     open(self.cache_dir + '/sell4.html', 'wb').write(rs.read())
 
     self.browser.select_form(name='submitLoansForSale')
     encoded = []
+    listed = []
+    by_ids = dict(((note.loan_id, note.order_id), note) for note in notes)
     for i in xrange(len(notes)):
       try:
-        for note in notes:
-          loan_id = int(self.browser.form.find_control('loan_id', nr=i).value)
-          order_id = int(self.browser.form.find_control('order_id', nr=i).value)
-          if note.loan_id == loan_id and note.order_id == order_id:
-            asking_price = asking_price_fn(note, markup)
-            asking_price = '%.2f' % asking_price
-            self.browser.form.find_control('asking_price',
-                                           nr=i).value = asking_price
-            encoded.append({'noteId': str(note.note_id),
-                            'loanId': str(note.loan_id),
-                            'orderId': str(note.order_id),
-                            'askingPrice': str(asking_price)})
-            assert float(asking_price) > 0.0
+        loan_id = int(self.browser.form.find_control('loan_id', nr=i).value)
+        order_id = int(self.browser.form.find_control('order_id', nr=i).value)
+        note = by_ids.get((loan_id, order_id))
+        if note is not None:
+          asking_price = asking_price_fn(note, markup)
+          asking_price = '%.2f' % asking_price
+          self.browser.form.find_control('asking_price',
+                                         nr=i).value = asking_price
+          encoded.append({'noteId': str(note.note_id),
+                          'loanId': str(note.loan_id),
+                          'orderId': str(note.order_id),
+                          'askingPrice': str(asking_price)})
+          listed.append(note)
+          assert float(asking_price) > 0.0
       except Exception:
         log.exception('fewer selling notes than expected %d' % i)
     self.browser.form.find_control('json').readonly = False
     self.browser.form.find_control('json').value = json.dumps(encoded)
-    rs = self.browser.submit()
+    rs = self.submit()
+    for note in listed:
+      self.index.add_listed(note)
     open(self.cache_dir + '/sell5.html', 'wb').write(rs.read())
     log.info(extract_msg_from_html(self.cache_dir + '/sell5.html',
                                    r'(You have made .* available for sale)'))
@@ -321,19 +716,20 @@ class LendingClubBrowser(object):
       options[name] = options_given.pop(name, default)
     if options_given:
       log.error('unknown options: %s', str(options_given))
-    options_url = (('https://www.lendingclub.com/foliofn/'
-                    'tradingInventory.action?{0}')
-                   .format(urllib.urlencode(sorted(options.items()), True)))
+    options_url = self.url('/foliofn/tradingInventory.action?{0}'.format(
+        urllib.urlencode(sorted(options.items()), True)))
     self.login()
     log.info('fetching: %s', options_url)
-    rs = self.browser.open(
-        'https://www.lendingclub.com/foliofn/tradingInventory.action')
-    open(self.cache_dir + '/inventory0.html', 'wb').write(rs.read())
-    rs = self.browser.open(options_url)
-    open(self.cache_dir + '/inventory1.html', 'wb').write(rs.read())
-    with open(os.path.join(self.cache_dir, 'tradinginventory.csv'), 'wb') as fd:
-      fd.write(self.browser.open(
-          'https://www.lendingclub.com/foliofn/notesRawData.action').read())
+    with runstats.span('fetch_trading_inventory'):
+      rs = self.open(
+          self.url('/foliofn/tradingInventory.action'))
+      open(self.cache_dir + '/inventory0.html', 'wb').write(rs.read())
+      rs = self.open(options_url)
+      open(self.cache_dir + '/inventory1.html', 'wb').write(rs.read())
+      with open(os.path.join(self.cache_dir, 'tradinginventory.csv'),
+                'wb') as fd:
+        fd.write(self.open(
+            self.url('/foliofn/notesRawData.action')).read())
     log.info('fetching trading notes list csv done')
 
   def load_trading_inventory(self):
@@ -351,8 +747,8 @@ class LendingClubBrowser(object):
   def fetch_new_inventory(self):
     self.login()
     log.info('fetching new inventory')
-    rs = self.browser.open(
-        'https://www.lendingclub.com/browse/browseNotesRawDataV2.action')
+    rs = self.open(
+        self.url('/browse/browseNotesRawDataV2.action'))
     open(self.cache_dir + '/browseNotesRawDataV2.csv', 'wb').write(rs.read())
 
   def load_new_inventory(self):
@@ -362,37 +758,35 @@ class LendingClubBrowser(object):
       rows.append(row)
     return rows
 
+  @runstats.timed('buy_trading_notes')
   def buy_trading_notes(self, notes):
     if len(notes) == 0:
       return
     self.login()
     log.info('buying %d trading notes' % len(notes))
-    time.sleep(1.5)  # Avoid 503 server errors
-    self.browser.open(
-        'https://www.lendingclub.com/foliofn/tradingInventory.action')
+    self.open(
+        self.url('/foliofn/tradingInventory.action'))
     for si, note in enumerate(notes):
-      time.sleep(1.5)  # Avoid 503 server errors
-      rs = self.browser.open(
-          'https://www.lendingclub.com/foliofn/noteAj.action?' +
-          's=true&si=%d&ps=1&ni=%d&rnd=%d' %
-          (si, note.note_id, random.randint(0, 2 ** 31)))
+      rs = self.open(
+          self.url('/foliofn/noteAj.action?'
+                   's=true&si=%d&ps=1&ni=%d&rnd=%d' %
+                   (si, note.note_id, random.randint(0, 2 ** 31))))
       open(self.cache_dir + '/buytrading0.json', 'wb').write(rs.read())
 
-    time.sleep(1.5)  # Avoid 503 server errors
-    rs = self.browser.open(
-        'https://www.lendingclub.com/foliofn/addToCartAj.action?rnd=%d' %
-        random.randint(0, 2 ** 31))
+    rs = self.open(
+        self.url('/foliofn/addToCartAj.action?rnd=%d' %
+                 random.randint(0, 2 ** 31)))
     open(self.cache_dir + '/buytrading1.json', 'wb').write(rs.read())
     log.info('trading cart: %s',
              open(self.cache_dir + '/buytrading1.json').read())
 
-    time.sleep(1.5)  # Avoid 503 server errors
-    rs = self.browser.open('https://www.lendingclub.com/foliofn/cart.action')
+    rs = self.open(self.url('/foliofn/cart.action'))
     open(self.cache_dir + '/buytrading2.html', 'wb').write(rs.read())
     self.browser.select_form(nr=0)
 
-    time.sleep(1.5)  # Avoid 503 server errors
-    rs = self.browser.submit()
+    rs = self.submit()
+    for note in notes:
+      self.index.add_buying(note)
     open(self.cache_dir + '/buytrading3.html', 'wb').write(rs.read())
     log.info(extract_msg_from_html(
         self.cache_dir + '/buytrading3.html',
@@ -405,16 +799,18 @@ class LendingClubBrowser(object):
     self.login()
     amount = str(amount)
     log.info('Withdrawing ' + amount)
-    self.browser.open('https://www.lendingclub.com/account/withdraw.action')
+    self.open(self.url('/account/withdraw.action'))
     self.browser.select_form(nr=0)
     self.browser['amount'] = amount
-    rsp = self.browser.submit()
+    rsp = self.submit()
     open(self.cache_dir + '/transfersummary.html', 'wb').write(rsp.read())
 
   def due_date_payed_fraction(self, date):
     """
     Return fraction of notes due on date that are payed as a tuple
     """
+    if self._notes is None and self.columns is not None:
+      return self.columns.due_date_payed_fraction(date)
     payed = 0
     count = 0
     for note in self.notes:
@@ -450,6 +846,16 @@ class LendingClubBrowser(object):
         self.fetch_trading_inventory(**strategy.search_options)
         notes = self.load_trading_inventory()
     notes.sort(key=strategy.sort_key)
+    stale_cutoff = datetime.datetime.now() - datetime.timedelta(days=14)
+    fetch_errors = dict()
+    with runstats.span('fetch_details'):
+      for note, exc_info in self.iter_fetch_details(
+          self.stale_buy_candidates(strategy, notes, loan_id_counts, cash,
+                                    max_notes_per_loan, stale_cutoff)):
+        if exc_info is None:
+          count_fetched += 1
+        else:
+          fetch_errors[note.note_id] = exc_info
     for note in notes:
       try:
         count_total += 1
@@ -461,11 +867,9 @@ class LendingClubBrowser(object):
           continue
         if not strategy.initial_filter(note):
           continue
-        if note.last_updated() < (datetime.datetime.now() -
-                                  datetime.timedelta(days=14)):
-          time.sleep(1.5)
-          self.fetch_details(note)
-          count_fetched += 1
+        if note.note_id in fetch_errors:
+          exc_info = fetch_errors[note.note_id]
+          raise exc_info[0], exc_info[1], exc_info[2]
         note.load_details()
         if not strategy.initial_filter(note):
           continue
@@ -494,18 +898,51 @@ class LendingClubBrowser(object):
 
     return buy
 
+  def stale_buy_candidates(self, strategy, notes, loan_id_counts, cash,
+                           max_notes_per_loan, stale_cutoff):
+    """
+    Notes buy_trading_with_strategy may need fresh details for, a superset
+    of what it will examine since cash only goes down as notes are bought
+    """
+    reasons = strategy.reasons
+    strategy.reset_reasons()  # don't double count initial_filter reasons
+    rv = list()
+    for note in notes:
+      try:
+        if (loan_id_counts[note.loan_id] < max_notes_per_loan and
+                note.asking_price + strategy.reserve_cash <= cash and
+                strategy.initial_filter(note) and
+                note.last_updated() < stale_cutoff):
+          rv.append(note)
+      except KeyboardInterrupt:
+        raise
+      except Exception:
+        pass  # reported when buy_trading_with_strategy examines the note
+    strategy.reasons = reasons
+    return rv
+
   def sell_with_strategy(self, strategy, markup, fraction):
     """Examine fraction of all notes and sell those found by strategy"""
     assert isinstance(strategy, SellStrategy)
     assert 0 <= fraction <= 1.0
     assert 0.5 <= markup <= 1.5
-    all_notes = self.load_notes()
+    columns = self.load_note_columns()
+    if columns is not None:
+      total = len(columns)
+    else:
+      total = len(self.load_notes())
     if fraction == 0:
       return
     already_selling_ids = self.get_already_selling_ids()
-    can_sell = filter(lambda x: x.note_id not in already_selling_ids, all_notes)
-    can_sell = filter(Note.can_sell, can_sell)
-    can_sell.sort(key=Note.last_updated)
+    if columns is not None:
+      can_sell = columns.sellable_notes(exclude_note_ids=already_selling_ids)
+    else:
+      can_sell = filter(lambda x: x.note_id not in already_selling_ids,
+                        self.notes)
+      can_sell = filter(Note.can_sell, can_sell)
+    # notes that changed in notes.csv are checked first, then the oldest
+    updated = self.notes_delta().updated()
+    can_sell.sort(key=lambda x: (x.note_id not in updated, x.last_updated()))
     count = int(round(fraction * len(can_sell)))
     in_window = can_sell[:count]
     if not can_sell:
@@ -517,37 +954,59 @@ class LendingClubBrowser(object):
     log.info('check range %s to %s', in_window[0].last_updated(),
              in_window[-1].last_updated())
     log.info('checking %s notes of %s sellable and %s total',
-             len(in_window), len(can_sell), len(all_notes))
-    sell = []
+             len(in_window), len(can_sell), total)
+    self.checked_note_ids.update(note.note_id for note in in_window)
+    candidates = []
     for note in in_window:
       try:
-        if not strategy.initial_filter(note):
-          continue
-        time.sleep(1)
-        self.fetch_details(note)
-        note.load_details()
-        if not note.can_sell():
-          continue
-        if not strategy.initial_filter(note):
-          continue
-        if not strategy.details_filter(note):
-          continue
-        sell.append(note)
+        if strategy.initial_filter(note):
+          candidates.append(note)
       except KeyboardInterrupt:
         raise
       except:
         log.exception('failed to load note')
         strategy.reasons['error'] += 1
+    sell = []
+    with runstats.span('fetch_details'):
+      for note, exc_info in self.iter_fetch_details(candidates):
+        try:
+          if exc_info is not None:
+            raise exc_info[0], exc_info[1], exc_info[2]
+          note.load_details()
+          if not note.can_sell():
+            continue
+          if not strategy.initial_filter(note):
+            continue
+          if not strategy.details_filter(note):
+            continue
+          sell.append(note)
+        except KeyboardInterrupt:
+          raise
+        except:
+          log.exception('failed to load note')
+          strategy.reasons['error'] += 1
+    # fetches complete out of order, sell in the order notes were checked
+    order = dict((note.note_id, i) for i, note in enumerate(candidates))
+    sell.sort(key=lambda x: order[x.note_id])
     log.info('will automatically sell %s ids: %s', len(sell),
              str(map(lambda x: x.note_id, sell)))
     log.info('sell reasons: %s',
              pformat(sorted(strategy.reasons.items(), key=lambda x: -x[1]),
                      indent=2, width=100))
+    try:
+      with runstats.span('pricing'):
+        prices = dict(zip([note.note_id for note in sell],
+                          strategy.sale_prices(sell, markup)))
+      sale_price = lambda x_note, x_markup: prices[x_note.note_id]
+    except KeyboardInterrupt:
+      raise
+    except Exception:
+      log.exception('batch pricing failed, pricing notes one at a time')
+      sale_price = strategy.sale_price
     for note in sell:
       # Selling all notes at once often causes server errors, instead do 1
       # at a time
-      self.sell_notes([note], markup, strategy.sale_price)
-      time.sleep(1)
+      self.sell_notes([note], markup, sale_price)
 
     with open(os.path.join(self.cache_dir, 'sell_log.txt'), 'w') as o:
       for note in sell:
@@ -562,16 +1021,12 @@ class LendingClubBrowser(object):
 
   def sell_duplicate_notes(self, markup):
     already_selling_ids = set(self.get_already_selling_ids())
-    active = self.load_notes()
-    active = list(filter(lambda x: x.note_id not in already_selling_ids,
-                         active))
-    active.sort(key=lambda x: x.loan_id)
+    self.load_notes()
     dups = list()
-    last_id = None
-    for note in active:
-      if note.loan_id == last_id:
-        dups.append(note)
-      last_id = note.loan_id
+    for notes in self.index.by_loan_id.itervalues():
+      if len(notes) > 1:
+        active = [x for x in notes if x.note_id not in already_selling_ids]
+        dups.extend(active[1:])
     log.info('selling %d duplicate notes' % len(dups))
     self.sell_notes(dups, markup)
 
@@ -640,7 +1095,7 @@ class Note(object):
       if trading_row['NeverLate'].lower() not in ('true', 'false'):
         log.warning('unknown value for NeverLate: %s', trading_row['NeverLate'])
       self.never_late = (trading_row['NeverLate'].lower() == 'true')
-      self.mine = self.note_id in [x.note_id for x in lendingclub.notes]
+      self.mine = lendingclub.index.has_note(self.note_id)
       self.term = None
       self.next_payment = None
       self.remaining_payments = int(trading_row['Remaining Payments'])
@@ -671,17 +1126,28 @@ class Note(object):
 
   def details_uri(self):
     if self.mine:
-      return ('https://www.lendingclub.com/account/loanPerf.action'
-              '?loan_id=%d&order_id=%d&note_id=%d' % (
-                  self.loan_id, self.order_id, self.note_id))
+      return self.lendingclub.url(
+          '/account/loanPerf.action?loan_id=%d&order_id=%d&note_id=%d' % (
+              self.loan_id, self.order_id, self.note_id))
     else:
-      return ('https://www.lendingclub.com/foliofn/loanPerf.action'
-              '?loan_id=%d&order_id=%d&note_id=%d' % (
-                  self.loan_id, self.order_id, self.note_id))
+      return self.lendingclub.url(
+          '/foliofn/loanPerf.action?loan_id=%d&order_id=%d&note_id=%d' % (
+              self.loan_id, self.order_id, self.note_id))
 
   def cache_path(self):
     return '%s/%d.html' % (self.lendingclub.cache_dir, self.note_id)
 
+  def meta_path(self):
+    return self.cache_path() + '.meta'
+
+  def details_meta(self):
+    """Validators and sha1 of the cached details page, written by fetch"""
+    try:
+      with open(self.meta_path(), 'rb') as fd:
+        return json.load(fd)
+    except (IOError, ValueError):
+      return dict()
+
   def last_updated(self):
     try:
       return datetime.datetime.fromtimestamp(os.path.getmtime(
@@ -690,10 +1156,27 @@ class Note(object):
       return datetime.datetime(2000, 1, 1)
 
   def load_details(self):
-    soup = BeautifulSoup(open(self.cache_path(), 'rb').read())
-    self.credit_history = extract_credit_history(soup)
-    self.collection_log = extract_collection_log(soup)
-    self.payment_history = extract_payment_history(soup)
+    data = open(self.cache_path(), 'rb').read()
+    page_hash = hashlib.sha1(data).hexdigest()
+    store = self.lendingclub.details_store
+    details = store.get(self.note_id, page_hash)
+    runstats.count('details_loaded')
+    if details is not None:
+      credit_history, collection_log, payment_history = details
+      self.credit_history = [CreditPoint(*x) for x in credit_history]
+      self.collection_log = [CollectionLogItem(*x) for x in collection_log]
+      self.payment_history = [PaymentHistoryItem(*x) for x in payment_history]
+    else:
+      t0 = time.time()
+      (self.credit_history, self.collection_log,
+       self.payment_history) = extract_details(data)
+      runstats.count('details_parsed')
+      runstats.add_time('details_parse', time.time() - t0)
+      store.put(self.note_id, page_hash,
+                [(x.date, x.low, x.high) for x in self.credit_history],
+                [(x.date, x.msg) for x in self.collection_log],
+                [(x.due, x.complete, x.status, x.amounts)
+                 for x in self.payment_history])
     if self.next_payment is None and self.payment_history:
       if ('Scheduled' in self.payment_history[0].status or
               'Processing' in self.payment_history[0].status):
@@ -902,12 +1385,50 @@ class SellStrategy(Strategy):
   def sale_price(self, note, markup):
     return note.par_value() * markup
 
+  def sale_prices(self, notes, markup):
+    """
+    sale_price for many notes, override to price them in a batch.
+    Returns a list of prices in the order of notes.
+    """
+    return [self.sale_price(note, markup) for note in notes]
+
+
+parsedate = dateparse.parsedate
 
-def parsedate(s):
-  p = pdt.Calendar()
-  if s == '--':
-    return None
-  return datetime.date(*p.parse(s)[0][0:3])
+# notes.csv fields that make a note worth looking at again
+NOTE_DIFF_FIELDS = ('Status', 'PrincipalRemaining', 'NextPaymentDate', 'Trend')
+
+
+class NotesDelta(collections.namedtuple('NotesDelta',
+                                        ['new', 'removed', 'changed'])):
+  """Sets of NoteIds that differ between two notes.csv snapshots"""
+
+  def updated(self):
+    return self.new | self.changed
+
+
+def read_notes_csv_fields(filename, fields):
+  rv = dict()
+  try:
+    fd = open(filename, 'rb')
+  except IOError:
+    return rv
+  with fd:
+    for row in csv.DictReader(fd):
+      try:
+        rv[int(row['NoteId'])] = tuple(row[f] for f in fields)
+      except (KeyError, TypeError, ValueError):
+        log.exception('reading %s', filename)
+  return rv
+
+
+def diff_notes_csv(old_filename, new_filename, fields=NOTE_DIFF_FIELDS):
+  old = read_notes_csv_fields(old_filename, fields)
+  new = read_notes_csv_fields(new_filename, fields)
+  return NotesDelta(
+      new=set(new) - set(old),
+      removed=set(old) - set(new),
+      changed=set(k for k, v in new.iteritems() if k in old and old[k] != v))
 
 
 def extract_row(tr, tag='td'):
@@ -929,7 +1450,35 @@ def extract_table(table):
   return rv
 
 
+def extract_rows(elements):
+  return [extract_row(tr) for element in elements
+          for tr in element.findAll('tr')]
+
+
+def extract_details(html):
+  """
+  Returns (credit_history, collection_log, payment_history) from a note
+  details page.  Uses detailsparser to parse only the needed parts of the
+  page, falling back to BeautifulSoup for markup it does not handle.
+  """
+  regions = detailsparser.extract_regions(html)
+  if regions is None:
+    from BeautifulSoup import BeautifulSoup
+    soup = BeautifulSoup(html)
+    return (extract_credit_history(soup),
+            extract_collection_log(soup),
+            extract_payment_history(soup))
+  return (credit_history_from_rows(regions['trend-data']),
+          collection_log_from_rows(regions['lcLoanPerfTable2']),
+          payment_history_from_rows(regions['lcLoanPerf1']))
+
+
 def extract_credit_history(soup):
+  return credit_history_from_rows(
+      extract_rows(soup.findAll('table', {'id': 'trend-data'})))
+
+
+def credit_history_from_rows(rows):
   def parsecredit(s):
     s = s.strip()
     if s == '780+':
@@ -940,15 +1489,17 @@ def extract_credit_history(soup):
     return l, h
 
   rv = list()
-  for table in soup.findAll('table', {'id': 'trend-data'}):
-    for tr in table.findAll('tr'):
-      tds = extract_row(tr)
-      if len(tds) == 2:
-        rv.append(CreditPoint(*((parsedate(tds[1]),) + parsecredit(tds[0]))))
+  for tds in rows:
+    if len(tds) == 2:
+      rv.append(CreditPoint(*((parsedate(tds[1]),) + parsecredit(tds[0]))))
   return rv
 
 
 def make_form(src, dest, values):
+  try:
+    from mechanize import ParseFile as ClientFormParseFile
+  except ImportError:
+    from ClientForm import ParseFile as ClientFormParseFile
   req = StringIO()
   print >> req, '<form method="POST" action="%s">' % dest
   for k, v in values.items():
@@ -959,24 +1510,31 @@ def make_form(src, dest, values):
 
 
 def extract_collection_log(soup):
+  return collection_log_from_rows(
+      extract_rows(soup.findAll('table', {'id': 'lcLoanPerfTable2'})))
+
+
+def collection_log_from_rows(rows):
   rv = list()
-  for table in soup.findAll('table', {'id': 'lcLoanPerfTable2'}):
-    for tr in table.findAll('tr'):
-      date, msg = extract_row(tr)
-      date = parsedate(re.sub('[(].*[)]', '', date))
-      msg = str(msg)
-      rv.append(CollectionLogItem(date, msg))
+  for row in rows:
+    date, msg = row
+    date = parsedate(re.sub('[(].*[)]', '', date))
+    msg = str(msg)
+    rv.append(CollectionLogItem(date, msg))
   return rv
 
 
 def extract_payment_history(soup):
+  return payment_history_from_rows(
+      extract_rows(soup.findAll('div', {'id': 'lcLoanPerf1'})))
+
+
+def payment_history_from_rows(rows):
   rv = list()
-  for table in soup.findAll('div', {'id': 'lcLoanPerf1'}):
-    for tr in table.findAll('tr'):
-      row = extract_row(tr)
-      if len(row) > 3:
-        rv.append(PaymentHistoryItem(parsedate(row[0]), parsedate(
-            row[1]), row[-2], map(lambda x: re.sub('^[$]', '', x), row[2:-2])))
+  for row in rows:
+    if len(row) > 3:
+      rv.append(PaymentHistoryItem(parsedate(row[0]), parsedate(
+          row[1]), row[-2], map(lambda x: re.sub('^[$]', '', x), row[2:-2])))
   return rv
 
 
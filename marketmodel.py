@@ -4,69 +4,126 @@ __author__ = 'Jason Ansel (jansel@jansel.net)'
 __copyright__ = '(C) 2012-2014. GNU GPL 3.'
 
 import argparse
+import array
 import collections
+import compactforest
 import csv
 import datetime
+import hashlib
+import historystore
+import importlib
+import itertools
+import json
 import logging
+import multiprocessing
 import numpy
 import os
 import pickle
+import Queue
 import random
 import re
-import sklearn.ensemble
-import sklearn.metrics
+import runstats
+import shutil
 import time
+import traceback
 
 from pprint import pprint
 
 log = logging.getLogger(__name__)
 
 MARKETMODEL_PK_FILE = 'cache/marketmodel.pk'
+MARKETMODEL_COMPACT_DIR = 'cache/marketmodel'
+TRADING_HISTORY_STORE_DIR = 'cache/trading_history'
 SOLD_TIMEOUT_HOURS = 24
 CHECK_FREQUENCY = 2
 
+# (name, estimator, params) fit by train without --sweep
+TRAIN_CONFIG = ('random_forest', 'sklearn.ensemble.RandomForestClassifier',
+                {'n_estimators': 100, 'max_features': None})
+
+# (name, estimator, {parameter: values}) tried by train --sweep, every
+# combination of values is fit
+SWEEP_GRID = [
+    ('random_forest', 'sklearn.ensemble.RandomForestClassifier',
+     {'n_estimators': [25, 50, 100],
+      'max_features': [None, 'sqrt'],
+      'min_samples_leaf': [1, 5]}),
+    ('extra_trees', 'sklearn.ensemble.ExtraTreesClassifier',
+     {'n_estimators': [50, 100],
+      'max_features': [None, 'sqrt'],
+      'min_samples_leaf': [1, 5]}),
+]
+
 
 def normalize_feature_vector(feature_vector):
   feature_vector[IDX_MARKUP] = (feature_vector[IDX_ASK] /
                                 feature_vector[IDX_VALUE] * 100.0 - 100.0)
 
 
+def ask_changed(ask, first_timestamp, asks):
+  """
+  True if asks, mapping AskPrice to the first timestamp it was listed at,
+  shows the price of a note first listed at ask changing within
+  SOLD_TIMEOUT_HOURS.  Such notes are not always_the_same and are left out
+  of training.
+  """
+  for new_ask, timestamp in asks.iteritems():
+    if (new_ask != ask and
+            timestamp - first_timestamp <= 3600 * SOLD_TIMEOUT_HOURS):
+      return True
+  return False
+
+
 class TradingNoteHistory(object):
-  def __init__(self, timestamp, properties, feature_vector, raw_row):
+  """
+  What training needs to know about a note seen in trading_history
+  snapshots, the csv row it was first seen in is not kept
+  """
+  __slots__ = ('note_id', 'ask', 'days_since_payment', 'feature_vector',
+               'always_the_same', 'first_timestamp', 'last_timestamp')
+
+  def __init__(self, timestamp, properties, feature_vector):
+    self.note_id = properties.get('NoteId')
+    self.ask = properties['AskPrice']
+    self.days_since_payment = properties['DaysSinceLastPayment']
+    self.feature_vector = array.array('d', feature_vector)
     self.always_the_same = True
-    self.feature_vector = feature_vector
     self.first_timestamp = timestamp
     self.last_timestamp = timestamp
-    self.properties = properties
-    self.raw_row = raw_row
-
-  def merge(self, timestamp, properties, feature_vector):
-    # noinspection PyStatementEffect
-    feature_vector  # unused
-    self.first_timestamp = min(self.first_timestamp, timestamp)
-    self.last_timestamp = max(self.last_timestamp, timestamp)
-    if (properties['AskPrice'] != self.properties['AskPrice']
-            and self.get_seconds_listed() <= 3600 * SOLD_TIMEOUT_HOURS):
+
+  def merge_asks(self, last_timestamp, asks):
+    """
+    Merge later snapshots of the note, given their last timestamp and a dict
+    mapping each AskPrice seen to the first timestamp it was seen at
+    """
+    self.last_timestamp = max(self.last_timestamp, last_timestamp)
+    if ask_changed(self.ask, self.first_timestamp, asks):
       self.always_the_same = False
 
   def get_seconds_listed(self):
     return self.last_timestamp - self.first_timestamp
 
-  def should_include(self):
+  def should_include(self, now=None):
+    """
+    True if the note is a training example, i.e. we know by now whether it
+    sold within SOLD_TIMEOUT_HOURS
+    """
+    if now is None:
+      now = time.time()
     if not self.always_the_same:
       return False
-    if (self.first_timestamp > time.time() - 3600 * (SOLD_TIMEOUT_HOURS +
-                                                     2 * CHECK_FREQUENCY)):
+    if (self.first_timestamp > now - 3600 * (SOLD_TIMEOUT_HOURS +
+                                             2 * CHECK_FREQUENCY)):
       return False
-    if self.properties['DaysSinceLastPayment'] == -1:
+    if self.days_since_payment == -1:
       return False  # First payment
-    if self.properties['DaysSinceLastPayment'] >= 20:
+    if self.days_since_payment >= 20:
       return False  # Too close to due date
     return True
 
 
 def make_dict_decoder(mapping):
-  return lambda value: mapping[value]
+  return mapping.__getitem__
 
 
 def yield_decoder(value):
@@ -82,15 +139,20 @@ def days_since_last_payment_decoder(value):
     return int(value)
 
 
+LOAN_CLASS_RE = re.compile(r'^([A-Z])([0-9]+)$')
+FICO_RANGE_RE = re.compile(r'^([0-9]+)-([0-9]+)$')
+DATE_RE = re.compile(r'^([0-9]+)/([0-9]+)/([0-9]+)$')
+
+
 def loan_class_decoder(value):
-  m = re.match(r'^([A-Z])([0-9]+)$', value)
+  m = LOAN_CLASS_RE.match(value)
   return 10 * (ord(m.group(1)) - ord('A')) + int(m.group(2))
 
 
 def fico_range_decoder(value):
   if value == '499-':
     return [300, 499]
-  m = re.match(r'^([0-9]+)-([0-9]+)$', value)
+  m = FICO_RANGE_RE.match(value)
   return [int(m.group(1)), int(m.group(2))]
 
 
@@ -103,10 +165,23 @@ def fico_range_decoder2(value):
 
 
 def date_decoder(value):
-  m = re.match(r'^([0-9]+)/([0-9]+)/([0-9]+)$', value)
+  m = DATE_RE.match(value)
   return datetime.date(int(m.group(3)), int(m.group(1)), int(m.group(2)))
 
 
+def memoize_decoder(decoder):
+  """Cache results of a decoder for fields with few distinct values"""
+  cache = dict()
+
+  def memoized(value):
+    try:
+      return cache[value]
+    except KeyError:
+      result = cache[value] = decoder(value)
+      return result
+  return memoized
+
+
 PROPERTY_DECODERS = {
     'NoteId': int,
     'OrderId': int,
@@ -145,6 +220,7 @@ FEATURE_DECORERS_NAMES = [k for k, v in FEATURE_DECODERS]
 IDX_MARKUP = FEATURE_DECORERS_NAMES.index('Markup/Discount')
 IDX_ASK = FEATURE_DECORERS_NAMES.index('AskPrice')
 IDX_VALUE = FEATURE_DECORERS_NAMES.index('Principal + Interest')
+IDX_DAYS_SINCE_PAYMENT = FEATURE_DECORERS_NAMES.index('DaysSinceLastPayment')
 
 
 class BadLine(RuntimeError):
@@ -188,45 +264,361 @@ def load_inventory_row(row, filename='unknown', lineno=0):
   return properties, feature_vector
 
 
-def load_inventory(trading_history, timestamp, filename):
-  all_notes = set()
-  for lineno, row in enumerate(csv.DictReader(open(filename))):
+# decoders of categorical fields, worth memoizing in RowDecoder
+MEMOIZED_DECODERS = (days_since_last_payment_decoder, loan_class_decoder,
+                     fico_range_decoder1, fico_range_decoder2, date_decoder)
+
+
+class RowDecoder(object):
+  """
+  load_inventory_row compiled for the header of one snapshot: fields are
+  looked up by column index in csv.reader rows rather than by key in
+  csv.DictReader dicts, with memoized decoders for categorical fields
+  """
+
+  def __init__(self, header, filename='unknown'):
+    self.header = header
+    self.filename = filename
+    index = dict((key, i) for i, key in enumerate(header))
+
+    def compile_decoder(decoder):
+      if decoder in MEMOIZED_DECODERS:
+        return memoize_decoder(decoder)
+      return decoder
+
+    # a missing feature column (index None) fails every row, as before
+    self.features = [(key, index.get(key), compile_decoder(decoder))
+                     for key, decoder in FEATURE_DECODERS
+                     if decoder is not None]
+    self.properties = [(key, index[key], compile_decoder(decoder))
+                       for key, decoder in PROPERTY_DECODERS
+                       if key in index]
+    self.idx_note_id = index.get('NoteId')
+    self.complete = all(i is not None for key, i, decoder in self.features)
+
+  def check_length(self, row, lineno):
+    # messages match load_inventory_row on csv.DictReader rows
+    if len(row) > len(self.header):
+      raise BadLine('{}:{} line too short'.format(self.filename, lineno))
+
+  def field(self, row, key, i, lineno):
+    if i is None:
+      raise KeyError(key)
+    if i >= len(row):
+      raise BadLine('{}:{} line too long'.format(self.filename, lineno))
+    return row[i]
+
+  def decode(self, row, lineno=0):
+    """Returns (properties, feature_vector) like load_inventory_row"""
+    if len(row) != len(self.header) or not self.complete:
+      return self.decode_checked(row, lineno)
+    feature_vector = []
+    properties = {}
+    key = None
+    value = None
+    try:
+      for key, i, decoder in self.features:
+        value = properties[key] = decoder(row[i])
+        if value.__class__ is list:
+          feature_vector.extend(value)
+        else:
+          feature_vector.append(value)
+      for key, i, decoder in self.properties:
+        properties[key] = decoder(row[i])
+    except (TypeError, ValueError, AttributeError, KeyError):
+      raise BadLine('{}:{} failed to parse {}:{}'.format(
+          self.filename, lineno, key, value))
+    normalize_feature_vector(feature_vector)
+    return properties, feature_vector
+
+  def decode_checked(self, row, lineno):
+    """decode for rows that are the wrong length or missing columns"""
+    self.check_length(row, lineno)
+    feature_vector = []
+    properties = {}
+    key = None
+    value = None
+    try:
+      for key, i, decoder in self.features:
+        value = decoder(self.field(row, key, i, lineno))
+        properties[key] = value
+        if isinstance(value, list):
+          feature_vector.extend(value)
+        else:
+          feature_vector.append(value)
+      for key, i, decoder in self.properties:
+        properties[key] = decoder(self.field(row, key, i, lineno))
+    except (TypeError, ValueError, AttributeError, KeyError):
+      raise BadLine('{}:{} failed to parse {}:{}'.format(
+          self.filename, lineno, key, value))
+    normalize_feature_vector(feature_vector)
+    return properties, feature_vector
+
+  def decode_into(self, row, out, lineno=0):
+    """
+    Decode the features of row into the array out, and return the NoteId.
+    The properties are decoded too, so the same rows are rejected as by
+    decode, but only NoteId is kept.  The markup feature is left for the
+    caller to normalize.
+    """
+    self.check_length(row, lineno)
+    key = None
+    value = None
+    try:
+      values = []
+      if len(row) == len(self.header) and self.complete:
+        for key, i, decoder in self.features:
+          value = decoder(row[i])
+          values.append(value)
+        for key, i, decoder in self.properties:
+          value = decoder(row[i])
+      else:
+        for key, i, decoder in self.features:
+          value = decoder(self.field(row, key, i, lineno))
+          values.append(value)
+        for key, i, decoder in self.properties:
+          value = decoder(self.field(row, key, i, lineno))
+      out[:] = values
+      key = 'NoteId'
+      return int(self.field(row, key, self.idx_note_id, lineno))
+    except (TypeError, ValueError, AttributeError, KeyError):
+      raise BadLine('{}:{} failed to parse {}:{}'.format(
+          self.filename, lineno, key, value))
+
+
+def iter_inventory_rows(filename):
+  """
+  Yields (lineno, row) for the non-blank data rows of a snapshot, and
+  the header as (1, header) first.  Line numbers count the header as line
+  1 and skip blank lines.
+  """
+  with open(filename) as fd:
+    reader = csv.reader(fd)
+    header = next(reader, None)
+    if header is None:
+      return
+    yield 1, header
+    lineno = 1
+    for row in reader:
+      if row:
+        lineno += 1
+        yield lineno, row
+
+
+def iter_inventory(filename):
+  """Yields (properties, feature_vector, lineno) for good lines of a snapshot"""
+  rows = iter_inventory_rows(filename)
+  header = next(rows, (1, None))[1]
+  if header is None:
+    return
+  decoder = RowDecoder(header, filename)
+  for lineno, row in rows:
     try:
-      properties, feature_vector = load_inventory_row(row, filename, lineno + 2)
+      properties, feature_vector = decoder.decode(row, lineno)
     except BadLine, e:
       log.error('BadLine: %s', e)
       continue
-    note_id = properties['NoteId']
-    if note_id in trading_history:
-      trading_history[note_id].merge(timestamp, properties, feature_vector)
-    else:
-      trading_history[note_id] = TradingNoteHistory(timestamp, properties,
-                                                    feature_vector, row)
-    all_notes.add(trading_history[note_id])
-
-    # grouped_notes = collections.defaultdict(list)
-    # for note in all_notes:
-    # grouped_notes[(note.properties['NeverLate'],
-    #                  note.properties['Status'],
-    #  #                note.properties['Loan Class']
-    #   )].append(note)
-    # for group in grouped_notes.values():
-    #   group.sort(key=lambda x: x.properties['Markup/Discount'])
-    #   for idx, note in enumerate(group):
-    #     if len(note.feature_vector) == len(FEATURE_DECODERS):
-    #       note.feature_vector += [idx]
-
-
-def load_trading_history(args):
-  filenames = os.listdir(args.directory)
+    yield properties, feature_vector, lineno
+
+
+def load_inventory_features(filename):
+  """
+  Bulk decode a snapshot into (note_ids, features) arrays, the features
+  are the feature vectors load_inventory_row would return for the rows it
+  accepts
+  """
+  rows = iter_inventory_rows(filename)
+  header = next(rows, (1, None))[1]
+  rows = list(rows)
+  n_features = len(FEATURE_DECORERS_NAMES)
+  features = numpy.empty((len(rows), n_features), dtype=numpy.float64)
+  note_ids = numpy.empty(len(rows), dtype=numpy.int64)
+  if header is None:
+    return note_ids, features
+  decoder = RowDecoder(header, filename)
+  if len(decoder.features) != n_features:
+    raise BadLine('{}: unsupported feature decoders'.format(filename))
+  n = 0
+  for lineno, row in rows:
+    try:
+      note_ids[n] = decoder.decode_into(row, features[n], lineno)
+      n += 1
+    except BadLine, e:
+      log.error('BadLine: %s', e)
+  features = features[:n]
+  note_ids = note_ids[:n]
+  features[:, IDX_MARKUP] = (features[:, IDX_ASK] /
+                             features[:, IDX_VALUE] * 100.0 - 100.0)
+  return note_ids, features
+
+
+def load_inventory_chunk(tasks):
+  """
+  Summarize a time ordered list of (timestamp, filename) snapshots as
+  {note_id: (TradingNoteHistory, asks)}, where asks maps each AskPrice seen
+  to the first timestamp it was seen at
+  """
+  summary = dict()
+  for timestamp, filename in tasks:
+    for properties, feature_vector, lineno in iter_inventory(filename):
+      note_id = properties['NoteId']
+      if note_id in summary:
+        note, asks = summary[note_id]
+        note.last_timestamp = max(note.last_timestamp, timestamp)
+      else:
+        note = TradingNoteHistory(timestamp, properties, feature_vector)
+        asks = dict()
+        summary[note_id] = (note, asks)
+      asks.setdefault(properties['AskPrice'], timestamp)
+  return summary
+
+
+def list_snapshots(directory):
+  """Sorted (timestamp, filename) of the <timestamp>.csv in directory"""
+  filenames = os.listdir(directory)
   matches = [re.match(r'^([0-9]+)[.]csv$', filename) for filename in filenames]
   timestamps = [int(m.group(1)) for m in matches if m is not None]
-  trading_history = dict()
-  for timestamp in sorted(timestamps):
-    print 'Processing', timestamp
-    filename = os.path.join(args.directory, '{}.csv'.format(timestamp))
-    load_inventory(trading_history, timestamp, filename)
-  return trading_history
+  return [(timestamp, os.path.join(directory, '{}.csv'.format(timestamp)))
+          for timestamp in sorted(timestamps)]
+
+
+def open_trading_history_store():
+  return historystore.TradingHistoryStore(TRADING_HISTORY_STORE_DIR,
+                                          FEATURE_DECORERS_NAMES)
+
+
+def trading_history_columns(notes):
+  """Columns of a historystore.TradingHistoryStore for TradingNoteHistory"""
+  features = numpy.array([note.feature_vector for note in notes],
+                         dtype=numpy.float64)
+  return {'note_id': [note.note_id for note in notes],
+          'first_timestamp': [note.first_timestamp for note in notes],
+          'last_timestamp': [note.last_timestamp for note in notes],
+          'flags': [historystore.FLAG_ALWAYS_THE_SAME
+                    if note.always_the_same else 0 for note in notes],
+          'ask': [note.ask for note in notes],
+          'value': features[:, IDX_VALUE] if len(notes) else [],
+          'features': features.reshape((len(notes),
+                                        len(FEATURE_DECORERS_NAMES)))}
+
+
+def combine_inventory_chunks(summaries):
+  """Combine time ordered load_inventory_chunk results into one summary"""
+  combined = dict()
+  for summary in summaries:
+    for note_id, (note, asks) in summary.iteritems():
+      if note_id in combined:
+        first_note, first_asks = combined[note_id]
+        first_note.last_timestamp = max(first_note.last_timestamp,
+                                        note.last_timestamp)
+        for ask, timestamp in asks.iteritems():
+          first_asks.setdefault(ask, timestamp)
+      else:
+        combined[note_id] = (note, asks)
+  return combined
+
+
+def summarize_snapshots(tasks, jobs=1):
+  """
+  load_inventory_chunk for time ordered (timestamp, filename) snapshots.
+  With jobs > 1, contiguous runs of snapshots are summarized by a pool of
+  processes and combined in timestamp order, with the same result.
+  """
+  if jobs <= 1 or len(tasks) <= 1:
+    return load_inventory_chunk(tasks)
+  # a few chunks per process to balance load, but each note is only sent
+  # back once per chunk
+  chunk_size = max(1, len(tasks) // (jobs * 4))
+  chunks = [tasks[i:i + chunk_size] for i in xrange(0, len(tasks), chunk_size)]
+  pool = multiprocessing.Pool(jobs)
+  try:
+    return combine_inventory_chunks(pool.imap(load_inventory_chunk, chunks))
+  finally:
+    pool.terminate()
+
+
+def update_trading_history_store(store, directory, jobs=1):
+  """
+  Merge the snapshots in directory that are not in store yet, so only new
+  snapshots are parsed.  Rows of notes already in the store get the same
+  last_timestamp and always_the_same as a full rebuild would give them.
+  The store is rebuilt from scratch if a new snapshot is older than one
+  already merged.
+  """
+  done = set(store.timestamps)
+  tasks = [task for task in list_snapshots(directory) if task[0] not in done]
+  if not tasks:
+    return store
+  if done and tasks[0][0] < max(done):
+    log.warning('snapshot %s is older than the trading history store, '
+                'rebuilding it', tasks[0][0])
+    store.clear()
+    return update_trading_history_store(store, directory, jobs)
+  log.info('merging %d new snapshots into %d notes', len(tasks), len(store))
+
+  summary = summarize_snapshots(tasks, jobs)
+
+  # notes already in the store: extend their lifetimes
+  note_ids = numpy.array(store.column('note_id'))
+  order = numpy.argsort(note_ids, kind='mergesort')
+  new_ids = numpy.array(sorted(summary), dtype=numpy.int64)
+  pos = numpy.searchsorted(note_ids[order], new_ids)
+  pos = numpy.minimum(pos, max(len(order) - 1, 0))
+  found = (numpy.zeros(len(new_ids), dtype=bool) if not len(order) else
+           note_ids[order][pos] == new_ids)
+  rows = order[pos[found]] if len(order) else numpy.zeros(0, dtype=int)
+  first_timestamp = store.column('first_timestamp')[rows]
+  last_timestamp = numpy.array(store.column('last_timestamp')[rows])
+  flags = numpy.array(store.column('flags')[rows])
+  ask = store.column('ask')[rows]
+  for i, note_id in enumerate(new_ids[found]):
+    note, asks = summary.pop(note_id)
+    last_timestamp[i] = max(last_timestamp[i], note.last_timestamp)
+    if ask_changed(ask[i], first_timestamp[i], asks):
+      flags[i] &= 0xff ^ historystore.FLAG_ALWAYS_THE_SAME
+  store.update('last_timestamp', rows, last_timestamp)
+  store.update('flags', rows, flags)
+
+  # notes seen for the first time
+  notes = []
+  for note_id in sorted(summary):
+    note, asks = summary[note_id]
+    note.merge_asks(note.last_timestamp, asks)
+    notes.append(note)
+  store.timestamps = sorted(done.union(task[0] for task in tasks))
+  store.append(trading_history_columns(notes))
+  log.info('updated %d notes and added %d', len(rows), len(notes))
+  return store
+
+
+def stored_should_include(store, now=None):
+  """TradingNoteHistory.should_include for every row of store"""
+  if now is None:
+    now = time.time()
+  days_since_payment = store.column('features')[:, IDX_DAYS_SINCE_PAYMENT]
+  return (((store.column('flags') & historystore.FLAG_ALWAYS_THE_SAME) != 0) &
+          (store.column('first_timestamp') <=
+           now - 3600 * (SOLD_TIMEOUT_HOURS + 2 * CHECK_FREQUENCY)) &
+          (days_since_payment != -1) &
+          (days_since_payment < 20))
+
+
+def stored_seconds_listed(store, idx):
+  return store.column('last_timestamp')[idx] - store.column(
+      'first_timestamp')[idx]
+
+
+def stored_feature_matrix(store, idx):
+  """
+  Feature vectors of rows idx of store.  Features are stored as float32,
+  which is what the classifier uses, but prices are kept exact.
+  """
+  features = numpy.array(store.column('features')[idx], dtype=numpy.float64)
+  features[:, IDX_ASK] = store.column('ask')[idx]
+  features[:, IDX_VALUE] = store.column('value')[idx]
+  features[:, IDX_MARKUP] = (features[:, IDX_ASK] /
+                             features[:, IDX_VALUE] * 100.0 - 100.0)
+  return features
 
 
 def reprice_feature_vector(row, ask_price=None, markup=None):
@@ -241,65 +633,127 @@ def reprice_feature_vector(row, ask_price=None, markup=None):
   return row_copy
 
 
+def reprice_feature_rows(features_matrix, owners, ask_prices):
+  """
+  reprice_feature_vector(features_matrix[owner], ask_price) for each owner
+  and ask price, as one matrix
+  """
+  rows = features_matrix[numpy.asarray(owners, dtype=numpy.intp)]
+  rows[:, IDX_ASK] = [round(ask_price, 2) for ask_price in ask_prices]
+  rows[:, IDX_MARKUP] = rows[:, IDX_ASK] / rows[:, IDX_VALUE] * 100.0 - 100.0
+  return rows
+
+
+def print_classifier_reports(clf, thresholds, test_data, test_target):
+  """classification_report at each threshold, from one predict_proba call"""
+  import sklearn.metrics
+  sell_proba = MarketModel(clf).sell_probas(test_data)
+  thresholds = numpy.asarray(thresholds)
+  preds = (sell_proba[:, numpy.newaxis] > thresholds).astype(int)
+  for i, thresh in enumerate(thresholds):
+    print 'Threshold', thresh
+    print sklearn.metrics.classification_report(test_target, preds[:, i])
+
+
 def print_classifier_report(clf, thresh, test_data, test_target):
-  market_model = MarketModel(clf)
-  print 'Threshold', thresh
-  preds = []
-  for row in test_data:
-    sell_proba = market_model.sell_proba_features(row)
-    preds.append(1 if sell_proba > thresh else 0)
-  print sklearn.metrics.classification_report(test_target, preds)
+  print_classifier_reports(clf, [thresh], test_data, test_target)
 
 
-def print_resell_opportunities(clf, thresh, test_notes):
+def print_resell_opportunities(clf, thresh, test_features, chunk_size=10000):
+  """
+  Notes likely to sell at more than 5% over their ask.  Sell probabilities
+  come from one predict_proba call and prices from predict_sale_prices,
+  chunk_size notes at a time.
+  """
   market_model = MarketModel(clf)
   stats = collections.Counter()
   row_fmt = '{:15} ' * len(FEATURE_DECORERS_NAMES)
   print row_fmt.format(*FEATURE_DECORERS_NAMES)
-  for note in test_notes:
-    sell_proba = market_model.sell_proba_trading_row(note.raw_row)
-    if sell_proba > thresh:
-      features = note.feature_vector
-      price = market_model.predict_sale_price(
-          features,
-          confidence=thresh,
-          min_price=features[IDX_ASK],
-          max_markup=1.25)
-      profit = round((price - features[IDX_ASK]) / features[IDX_ASK], 4)
+  test_features = numpy.asarray(test_features, dtype=numpy.float64)
+  sell_proba = market_model.sell_probas(test_features)
+  stats['no_sale'] = int((sell_proba <= thresh).sum())
+  candidates = numpy.flatnonzero(sell_proba > thresh)
+  for start in xrange(0, len(candidates), chunk_size):
+    features_list = [list(test_features[i])
+                     for i in candidates[start:start + chunk_size]]
+    asks = [features[IDX_ASK] for features in features_list]
+    prices = market_model.predict_sale_prices(
+        features_list,
+        confidence=thresh,
+        min_prices=asks,
+        max_markup=1.25)
+    for features, ask, (price, proba) in zip(features_list, asks, prices):
+      profit = round((price - ask) / ask, 4)
       if profit >= 0.05:
         print row_fmt.format(*features), profit
         stats['profit'] += 1
       else:
         stats['no_profit'] += 1
-    else:
-      stats['no_sale'] += 1
   pprint(stats.most_common())
 
 
 def load_train_test_notes(args):
-  if args.cached:
-    trading_history = pickle.load(open('cache/trading_history.pk', 'rb'))
-  else:
-    trading_history = load_trading_history(args)
-    pickle.dump(trading_history, open('cache/trading_history.pk', 'wb'), 2)
-  notes = filter(TradingNoteHistory.should_include, trading_history.values())
-  # notes.sort(key=lambda x: x.first_timestamp)
-  random.shuffle(notes)
-  data = []
-  target = []
-  for note in notes:
-    data.append(note.feature_vector)
-    target.append(1 if note.get_seconds_listed() <= SOLD_TIMEOUT_HOURS * 3600.0
-                  else 0)
-  data = numpy.array(data)
-  target = numpy.array(target)
+  """
+  Returns (test_data, test_target, train_data, train_target) from the
+  trading history store.  Unless args.cached, snapshots in args.directory
+  that are new since the last run are merged into the store first, or all
+  of them with args.rebuild.
+  """
+  store = open_trading_history_store()
+  if getattr(args, 'rebuild', False):
+    store.clear()
+  if not args.cached or not len(store):
+    update_trading_history_store(store, args.directory,
+                                 getattr(args, 'jobs', 1))
+  idx = list(numpy.flatnonzero(stored_should_include(store)))
+  random.shuffle(idx)
+  idx = numpy.array(idx, dtype=numpy.int64)
+  data = stored_feature_matrix(store, idx)
+  target = (stored_seconds_listed(store, idx) <=
+            SOLD_TIMEOUT_HOURS * 3600.0).astype(int)
   cutoff = int(len(data) * 0.8)
   train_data = data[:cutoff]
   train_target = target[:cutoff]
   test_data = data[cutoff:]
   test_target = target[cutoff:]
-  test_notes = notes[cutoff:]
-  return test_data, test_notes, test_target, train_data, train_target
+  return test_data, test_target, train_data, train_target
+
+
+def file_signature(filename, sha1=False):
+  """(size, mtime) of filename, plus its sha1 if asked for"""
+  st = os.stat(filename)
+  rv = {'size': st.st_size, 'mtime': st.st_mtime}
+  if sha1:
+    with open(filename, 'rb') as fd:
+      rv['sha1'] = hashlib.sha1(fd.read()).hexdigest()
+  return rv
+
+
+def compact_model_current():
+  """
+  True if MARKETMODEL_COMPACT_DIR was exported from the MARKETMODEL_PK_FILE
+  there now, according to the signature install_model saved with it.  A
+  pickle copied into place by hand makes the compact model stale.
+  """
+  if not os.path.exists(os.path.join(MARKETMODEL_COMPACT_DIR, 'meta.json')):
+    return False
+  if not os.path.exists(MARKETMODEL_PK_FILE):
+    return True
+  try:
+    with open(os.path.join(MARKETMODEL_COMPACT_DIR, 'source.json')) as fd:
+      source = json.load(fd)
+  except (IOError, ValueError):
+    source = dict()
+  current = file_signature(MARKETMODEL_PK_FILE)
+  if (source.get('size') == current['size'] and
+          source.get('mtime') == current['mtime']):
+    return True
+  if (source.get('size') == current['size'] and source.get('sha1') ==
+          file_signature(MARKETMODEL_PK_FILE, sha1=True)['sha1']):
+    return True
+  log.warning('%s does not match %s, ignoring it', MARKETMODEL_COMPACT_DIR,
+              MARKETMODEL_PK_FILE)
+  return False
 
 
 class MarketModel(object):
@@ -308,28 +762,44 @@ class MarketModel(object):
   @classmethod
   def instance(cls):
     if cls._instance is None:
-      if not os.path.exists(MARKETMODEL_PK_FILE):
-        return None
-      log.info('Loading market model')
-      cls._instance = cls(pickle.load(open(MARKETMODEL_PK_FILE, 'rb')))
+      with runstats.span('load_market_model'):
+        if compact_model_current():
+          log.info('Loading market model from %s', MARKETMODEL_COMPACT_DIR)
+          cls._instance = cls(compactforest.load(MARKETMODEL_COMPACT_DIR))
+        elif os.path.exists(MARKETMODEL_PK_FILE):
+          log.info('Loading market model')
+          cls._instance = cls(pickle.load(open(MARKETMODEL_PK_FILE, 'rb')))
+        else:
+          return None
     return cls._instance
 
   def __init__(self, clf):
     self.clf = clf
 
+  def predict_proba(self, rows):
+    runstats.count('model_calls')
+    runstats.count('model_rows', len(rows))
+    return self.clf.predict_proba(rows)
+
   def sell_proba_features(self, features, price=None):
     if price is not None:
       features[IDX_ASK] = price
       normalize_feature_vector(features)
-    return self.clf.predict_proba([features])[0][1]
+    return self.predict_proba([features])[0][1]
+
+  def sell_probas(self, features_matrix):
+    """sell_proba_features of every row, in one predict_proba call"""
+    if not len(features_matrix):
+      return numpy.zeros(0)
+    return numpy.asarray(self.predict_proba(features_matrix))[:, 1]
 
   def sell_proba_trading_row(self, row, price=None):
     features = load_inventory_row(row)[1]
     return self.sell_proba_features(features, price=price)
 
-  def predict_sale_price(self, features, confidence=0.5,
-                         min_markup=0.5, max_markup=1.5, step=0.01,
-                         min_price=None, max_price=None):
+  def price_grid(self, features, min_markup=0.5, max_markup=1.5, step=0.01,
+                 min_price=None, max_price=None):
+    """Returns min_price and the prices predict_sale_price considers"""
     if min_price is None:
       min_price = round(min_markup * features[IDX_VALUE], 2)
       if min_price / features[IDX_VALUE] < min_markup:
@@ -340,52 +810,386 @@ class MarketModel(object):
       if max_price / features[IDX_VALUE] > max_markup:
         max_price -= 0.01
       assert max_price / features[IDX_VALUE] <= max_markup
-    rows = []
+    prices = []
     price = min_price
     while price <= max_price:
-      rows.append(reprice_feature_vector(features, ask_price=price))
+      prices.append(price)
       price += step
+    return min_price, prices
+
+  def predict_sale_price(self, features, confidence=0.5,
+                         min_markup=0.5, max_markup=1.5, step=0.01,
+                         min_price=None, max_price=None, search='grid',
+                         probes=2, verify=False):
+    """
+    Highest price on the grid from min_price to max_price such that every
+    price up to it sells with probability >= confidence, or min_price.
+
+    search='grid' evaluates every price.  search='bisect' assumes the sell
+    probability decreases with price and narrows down the first price below
+    confidence evaluating probes prices per round, about 8 evaluations rather
+    than 100.  A forest's sell probability is not monotone in price, so
+    bisect can return a higher price than grid and is only an opt-in
+    approximation.  verify=True also runs the grid search, logs any
+    difference and returns the grid result.
+    """
+    min_price, prices = self.price_grid(features, min_markup, max_markup,
+                                        step, min_price, max_price)
+    if search == 'grid':
+      return self.grid_search_price(features, confidence, min_price, prices)
+    assert search == 'bisect'
+    price = self.bisect_search_price(features, confidence, min_price, prices,
+                                     probes)
+    if verify:
+      grid_price = self.grid_search_price(features, confidence, min_price,
+                                          prices)
+      if grid_price != price:
+        log.warning('bisect sale price %.2f differs from grid %.2f',
+                    price, grid_price)
+      return grid_price
+    return price
+
+  def grid_search_price(self, features, confidence, min_price, prices):
+    rows = [reprice_feature_vector(features, ask_price=price)
+            for price in prices]
     price = min_price
     if rows:
-      for row, proba in zip(rows, self.clf.predict_proba(rows)):
+      for row, proba in zip(rows, self.predict_proba(rows)):
         if proba[1] < confidence:
           break
         price = row[IDX_ASK]
     return price
 
+  def bisect_search_price(self, features, confidence, min_price, prices,
+                          probes=2):
+    price = min_price
+    # prices[lo] sells (or lo == -1), prices[hi] doesn't (or hi == len)
+    lo = -1
+    hi = len(prices)
+    while hi - lo > 1:
+      width = hi - lo
+      idxs = sorted(set(lo + width * i // (probes + 1)
+                        for i in xrange(1, probes + 1)) - {lo})
+      rows = [reprice_feature_vector(features, ask_price=prices[i])
+              for i in idxs]
+      for i, row, proba in zip(idxs, rows, self.predict_proba(rows)):
+        if proba[1] < confidence:
+          hi = i
+          break
+        lo = i
+        price = row[IDX_ASK]
+    return price
+
+  def predict_sale_prices(self, features_list, confidence=0.5,
+                          min_markup=0.5, max_markup=1.5, step=0.01,
+                          min_prices=None, max_prices=None, search='grid',
+                          probes=2, verify=False):
+    """
+    predict_sale_price for many notes at once, returns a list of
+    (price, sell probability at price).  The price grids of every note are
+    stacked into one predict_proba call, or one call per round for
+    search='bisect'.  As for predict_sale_price, verify=True with
+    search='bisect' logs the notes bisect prices differently and returns the
+    grid results.
+    """
+    if search == 'bisect' and verify:
+      grid = self.predict_sale_prices(features_list, confidence, min_markup,
+                                      max_markup, step, min_prices,
+                                      max_prices)
+      bisect = self.predict_sale_prices(features_list, confidence, min_markup,
+                                        max_markup, step, min_prices,
+                                        max_prices, 'bisect', probes)
+      differ = sum(1 for a, b in zip(grid, bisect) if a[0] != b[0])
+      if differ:
+        log.warning('bisect sale prices differ from grid for %d of %d notes',
+                    differ, len(grid))
+      return grid
+    n = len(features_list)
+    if min_prices is None:
+      min_prices = [None] * n
+    if max_prices is None:
+      max_prices = [None] * n
+    grids = [self.price_grid(features, min_markup, max_markup, step,
+                             min_price, max_price)
+             for features, min_price, max_price
+             in zip(features_list, min_prices, max_prices)]
+    features_matrix = numpy.array(features_list, dtype=numpy.float64)
+    prices = [min_price for min_price, grid in grids]
+    probas = [None] * n
+    lo = [-1] * n
+    hi = [len(grid) for min_price, grid in grids]
+    active = [j for j in xrange(n) if hi[j] > 0]
+    while active:
+      batch = []
+      for j in active:
+        if search == 'grid':
+          idxs = range(lo[j] + 1, hi[j])
+        else:
+          assert search == 'bisect'
+          width = hi[j] - lo[j]
+          idxs = sorted(set(lo[j] + width * i // (probes + 1)
+                            for i in xrange(1, probes + 1)) - {lo[j]})
+        batch.append((j, idxs))
+      rows = reprice_feature_rows(
+          features_matrix,
+          [j for j, idxs in batch for i in idxs],
+          [grids[j][1][i] for j, idxs in batch for i in idxs])
+      sell_proba = numpy.asarray(self.predict_proba(rows))[:, 1]
+      results = iter(zip(rows[:, IDX_ASK].tolist(), sell_proba.tolist()))
+      for j, idxs in batch:
+        for i in idxs:
+          price, proba = next(results)
+          if hi[j] <= i:
+            continue  # a lower price already failed
+          if proba < confidence:
+            hi[j] = i
+            if i == 0:
+              probas[j] = proba  # the probability at min_price
+          else:
+            lo[j] = i
+            prices[j] = price
+            probas[j] = proba
+      active = [j for j in active if hi[j] - lo[j] > 1]
+    missing = [j for j in xrange(n) if probas[j] is None]
+    if missing:
+      # empty price grids
+      rows = [reprice_feature_vector(features_list[j], ask_price=prices[j])
+              for j in missing]
+      for j, proba in zip(missing, self.predict_proba(rows)):
+        probas[j] = proba[1]
+    return zip(prices, probas)
+
   def predict_sale_price_trading_row(self, row, **kwargs):
     features = load_inventory_row(row)[1]
     return self.predict_sale_price(features, **kwargs)
 
 
+def sweep_configs(grid=SWEEP_GRID):
+  """List of (name, estimator, params) for every combination in grid"""
+  configs = []
+  for name, estimator, parameters in grid:
+    keys = sorted(parameters)
+    for values in itertools.product(*[parameters[k] for k in keys]):
+      configs.append((name, estimator, dict(zip(keys, values))))
+  return configs
+
+
+def make_classifier(estimator, params, n_jobs=1):
+  module, name = estimator.rsplit('.', 1)
+  clf = getattr(importlib.import_module(module), name)(**params)
+  if 'n_jobs' in clf.get_params():
+    clf.set_params(n_jobs=n_jobs)
+  return clf
+
+
+def is_forest(clf):
+  import sklearn.ensemble
+  return isinstance(clf, (sklearn.ensemble.RandomForestClassifier,
+                          sklearn.ensemble.ExtraTreesClassifier))
+
+
+def measure_latency(clf, test_data, samples=200):
+  """Median seconds for MarketModel to score one note, as the checker does"""
+  market_model = MarketModel(clf)
+  times = []
+  for row in test_data[:samples]:
+    row = list(row)
+    t0 = time.time()
+    market_model.sell_proba_features(row)
+    times.append(time.time() - t0)
+  return float(numpy.median(times)) if times else 0.0
+
+
+def fit_config(n, config, n_jobs, test_data, test_target, train_data,
+               train_target):
+  """
+  Fit one sweep config, saving it as cache/marketmodel_<n>.pk and, for
+  forests, cache/marketmodel_<n>/.  Accuracy and latency are measured on
+  the model MarketModel.instance() would load.
+  """
+  name, estimator, params = config
+  clf = make_classifier(estimator, params, n_jobs)
+  t0 = time.time()
+  clf.fit(train_data, train_target)
+  fit_seconds = time.time() - t0
+  if 'n_jobs' in clf.get_params():
+    clf.set_params(n_jobs=1)  # the checker scores notes one process
+  filename = 'cache/marketmodel_{}.pk'.format(n)
+  pickle.dump(clf, open(filename, 'wb'), 2)
+  model = clf
+  compact_dir = None
+  if is_forest(clf):
+    compact_dir = 'cache/marketmodel_{}'.format(n)
+    model = compactforest.export(clf, compact_dir)
+    diff = compactforest.verify(clf, model, test_data)
+    if diff > 1e-9:
+      log.warning('%s: compact export differs by %s', compact_dir, diff)
+  accuracy = float((model.predict(test_data) == test_target).mean())
+  return {'n': n,
+          'name': name,
+          'params': params,
+          'accuracy': accuracy,
+          'latency': measure_latency(model, test_data),
+          'fit_seconds': fit_seconds,
+          'filename': filename,
+          'compact_dir': compact_dir}
+
+
+def sweep_failure(n, config, error):
+  return {'n': n, 'name': config[0], 'params': config[2], 'error': error}
+
+
+def sweep_worker(results, n, config, n_jobs, data):
+  try:
+    results.put(fit_config(n, config, n_jobs, *data))
+  except Exception:
+    results.put(sweep_failure(n, config, traceback.format_exc()))
+
+
+def run_sweep(configs, data, jobs, poll_seconds=5.0):
+  """
+  Fit configs, up to jobs at a time, and return their fit_config results.
+  Each fit runs in its own non-daemonic process, which unlike a
+  multiprocessing.Pool worker may start the joblib workers used to build
+  trees in parallel, so the cpus are split between the two levels.  A
+  process that dies without a result, e.g. killed for using too much
+  memory, is logged as a failed config.
+  """
+  jobs = max(1, min(jobs, len(configs)))
+  n_jobs = max(1, multiprocessing.cpu_count() // jobs)
+  results = multiprocessing.Queue()
+  pending = list(enumerate(configs))
+  running = dict()
+  # polls since each exited process was first seen without a result
+  exited = collections.Counter()
+  done = []
+  while pending or running:
+    while pending and len(running) < jobs:
+      n, config = pending.pop(0)
+      process = multiprocessing.Process(
+          target=sweep_worker, args=(results, n, config, n_jobs, data))
+      process.start()
+      running[n] = (config, process)
+    try:
+      result = results.get(timeout=poll_seconds)
+    except Queue.Empty:
+      result = None
+      for n, (config, process) in sorted(running.items()):
+        if process.exitcode is None:
+          continue
+        # a clean exit flushes the result to the queue first, give it one
+        # more poll to arrive
+        exited[n] += 1
+        if process.exitcode != 0 or exited[n] > 1:
+          result = sweep_failure(n, config, 'process exited with code %s' %
+                                 process.exitcode)
+          break
+      if result is None:
+        continue
+    if result['n'] not in running:
+      continue  # already recorded as failed
+    running.pop(result['n'])[1].join()
+    if 'error' in result:
+      log.error('sweep config %s %s failed:\n%s', result['name'],
+                result['params'], result['error'])
+    else:
+      log.info('sweep config %s %s: accuracy %.4f latency %.3fms',
+               result['name'], result['params'], result['accuracy'],
+               1000.0 * result['latency'])
+      done.append(result)
+  return sorted(done, key=lambda r: r['n'])
+
+
+def print_sweep(results):
+  row_fmt = '{:>3} {:15} {:>9} {:>11} {:>8}  {}'
+  for title, key in (('by accuracy', lambda r: -r['accuracy']),
+                     ('by latency', lambda r: r['latency'])):
+    print
+    print 'Sweep results', title
+    print row_fmt.format('n', 'name', 'accuracy', 'latency ms', 'fit s',
+                         'params')
+    for r in sorted(results, key=key):
+      print row_fmt.format(r['n'], r['name'], '%.4f' % r['accuracy'],
+                           '%.3f' % (1000.0 * r['latency']),
+                           '%.1f' % r['fit_seconds'], r['params'])
+
+
+def choose_model(results, min_accuracy=None, slack=0.01):
+  """
+  The lowest latency result with accuracy of at least min_accuracy,
+  default within slack of the most accurate
+  """
+  if min_accuracy is None:
+    min_accuracy = max(r['accuracy'] for r in results) - slack
+  eligible = [r for r in results if r['accuracy'] >= min_accuracy]
+  if not eligible:
+    return None
+  return min(eligible, key=lambda r: (r['latency'], -r['accuracy']))
+
+
+def install_model(result):
+  """
+  Make result the model MarketModel.instance() loads; train does this with
+  the model it fits, with or without --sweep.  The compact export
+  is installed along with the signature of the pickle it came from, so
+  copying a different pickle to MARKETMODEL_PK_FILE by hand still works.
+  """
+  shutil.copyfile(result['filename'], MARKETMODEL_PK_FILE)
+  if os.path.isdir(MARKETMODEL_COMPACT_DIR):
+    shutil.rmtree(MARKETMODEL_COMPACT_DIR)
+  if result['compact_dir']:
+    shutil.copytree(result['compact_dir'], MARKETMODEL_COMPACT_DIR)
+    with open(os.path.join(MARKETMODEL_COMPACT_DIR, 'source.json'),
+              'w') as fd:
+      json.dump(file_signature(MARKETMODEL_PK_FILE, sha1=True), fd)
+  MarketModel._instance = None
+
+
 def train():
-  clfs = [sklearn.ensemble.RandomForestClassifier(100, max_features=None)]
   logging.basicConfig(level=logging.DEBUG)
   parser = argparse.ArgumentParser()
   parser.add_argument('--directory', default='trading_history')
   parser.add_argument('--cached', action='store_true')
+  parser.add_argument('--rebuild', action='store_true',
+                      help='reparse every snapshot, not just new ones')
+  parser.add_argument('--jobs', '-j', type=int,
+                      default=multiprocessing.cpu_count(),
+                      help='processes used to parse trading history and '
+                           'build trees')
+  parser.add_argument('--sweep', action='store_true',
+                      help='fit every config in SWEEP_GRID and install the '
+                           'fastest accurate one')
+  parser.add_argument('--sweep-jobs', type=int,
+                      help='configs fit at once (default --jobs)')
+  parser.add_argument('--min-accuracy', type=float,
+                      help='accuracy the installed model needs (default '
+                           'within 0.01 of the best)')
   args = parser.parse_args()
-  (test_data, test_notes, test_target,
+  (test_data, test_target,
    train_data, train_target) = load_train_test_notes(args)
-  for n, clf in enumerate(clfs):
-    filename = 'cache/marketmodel_{}.pk'.format(n)
-    print
-    print clf.__class__.__name__, filename
-    clf.fit(train_data, train_target)
-    pickle.dump(clf, open(filename, 'wb'), 2)
-    if hasattr(clf, 'feature_importances_'):
-      pprint(sorted(zip(clf.feature_importances_, FEATURE_DECORERS_NAMES)))
-    for i in range(1, 10):
-      thresh = i / 10.0
-      print_classifier_report(clf, thresh, test_data, test_target)
-    print_resell_opportunities(clf, 0.65, test_notes)
+  data = (test_data, test_target, train_data, train_target)
+  if args.sweep:
+    results = run_sweep(sweep_configs(), data, args.sweep_jobs or args.jobs)
+    print_sweep(results)
+    best = choose_model(results, args.min_accuracy)
+    if best is None:
+      print 'No model has accuracy', args.min_accuracy
+      return
+  else:
+    best = fit_config(0, TRAIN_CONFIG, args.jobs, *data)
+  install_model(best)
+  print
+  print 'Installed', best['name'], best['params'], 'as', MARKETMODEL_PK_FILE
+  clf = pickle.load(open(best['filename'], 'rb'))
+  print
+  print clf.__class__.__name__, best['filename'], best['compact_dir']
+  print 'accuracy', best['accuracy'], 'latency', best['latency']
+  if hasattr(clf, 'feature_importances_'):
+    pprint(sorted(zip(clf.feature_importances_, FEATURE_DECORERS_NAMES)))
+  print_classifier_reports(clf, [i / 10.0 for i in range(1, 10)], test_data,
+                           test_target)
+  print_resell_opportunities(clf, 0.65, test_data)
 
 
 if __name__ == '__main__':
   train()
-
-
-
-
-
-
@@ -0,0 +1,168 @@
+#!/usr/bin/python
+"""notecolumns.py: Columnar view of notes.csv with vectorized filters"""
+__version__ = '3.0'
+__author__ = 'Jason Ansel (jansel@jansel.net)'
+__copyright__ = '(C) 2012-2014. GNU GPL 3.'
+
+import csv
+import datetime
+import logging
+import numpy
+
+import dateparse
+
+log = logging.getLogger(__name__)
+
+# next_payment is a date ordinal, 0 when there is no next payment
+NOTE_DTYPE = numpy.dtype([('note_id', 'i8'),
+                          ('loan_id', 'i8'),
+                          ('order_id', 'i8'),
+                          ('status', 'i4'),
+                          ('principal', 'f8'),
+                          ('accrual', 'f8'),
+                          ('rate', 'f8'),
+                          ('term', 'i4'),
+                          ('remaining_payments', 'i4'),
+                          ('next_payment', 'i4'),
+                          ('next_payment_day', 'i1')])
+
+UNSELLABLE_STATUSES = ('Fully Paid', 'Default', 'Charged Off')
+
+
+def parse_row(row, col, statuses):
+  """
+  Parse a notes.csv row the same way Note.__init__ does, col maps field
+  names to indexes in row.  Returns a tuple in NOTE_DTYPE order.
+  """
+  status = row[col['Status']]
+  if status not in statuses:
+    statuses[status] = len(statuses)
+  principal = float(row[col['PrincipalRemaining']].replace('$', ''))
+  term = int(row[col['Term']])
+  next_payment = row[col['NextPaymentDate']]
+  if next_payment != 'null' and principal > 0.0:
+    next_payment = dateparse.parsedate(next_payment)
+  else:
+    next_payment = None
+  return (int(row[col['NoteId']]),
+          int(row[col['LoanId']]),
+          int(row[col['OrderId']]),
+          statuses[status],
+          principal,
+          float(row[col['Accrual']].replace('$', '')),
+          float(row[col['InterestRate']].strip('%')),
+          term,
+          int(term - float(row[col['PaymentsReceivedToDate']])),
+          next_payment.toordinal() if next_payment else 0,
+          next_payment.day if next_payment else 0)
+
+
+class NoteColumns(object):
+  """
+  The notes in notes.csv as a numpy structured array (see NOTE_DTYPE).
+  Rows are only turned into Note objects, by note_factory, when asked for
+  with note() or notes(), so filters can run over the whole portfolio
+  without building an object per note.
+  """
+
+  def __init__(self, fieldnames, rows, data, statuses, note_factory):
+    self.fieldnames = fieldnames
+    self.rows = rows
+    self.data = data
+    self.statuses = statuses
+    self.note_factory = note_factory
+    self.materialized = dict()
+
+  @classmethod
+  def load(cls, filename, note_factory):
+    rows = list()
+    parsed = list()
+    statuses = dict()
+    reader = csv.reader(open(filename, 'rb'))
+    fieldnames = next(reader, [])
+    col = dict((name, i) for i, name in enumerate(fieldnames))
+    for row in reader:
+      if not row:
+        continue  # csv.DictReader skips blank lines
+      try:
+        parsed.append(parse_row(row, col, statuses))
+        rows.append(row)
+      except Exception:
+        log.exception('loading note')
+    return cls(fieldnames, rows, numpy.array(parsed, dtype=NOTE_DTYPE),
+               statuses, note_factory)
+
+  def __len__(self):
+    return len(self.rows)
+
+  def row_dict(self, i):
+    """Row i as csv.DictReader returns it, missing fields are None"""
+    row = self.rows[i]
+    d = dict(zip(self.fieldnames, row))
+    for name in self.fieldnames[len(row):]:
+      d[name] = None
+    if len(row) > len(self.fieldnames):
+      d[None] = row[len(self.fieldnames):]
+    return d
+
+  def note(self, i):
+    try:
+      return self.materialized[i]
+    except KeyError:
+      note = self.note_factory(self.row_dict(i))
+      self.materialized[i] = note
+      return note
+
+  def notes(self, indexes=None):
+    """
+    Notes for rows indexes, default all.  parse_row does not check every
+    field note_factory reads, so rows it fails on are logged and skipped
+    as LendingClubBrowser.load_notes does.
+    """
+    if indexes is None:
+      indexes = xrange(len(self))
+    rv = list()
+    for i in indexes:
+      try:
+        rv.append(self.note(i))
+      except Exception:
+        log.exception('loading note')
+    return rv
+
+  def status_in(self, statuses):
+    codes = [self.statuses[s] for s in statuses if s in self.statuses]
+    return numpy.in1d(self.data['status'], codes)
+
+  def par_value(self):
+    return self.data['principal'] + self.data['accrual']
+
+  def can_sell(self, today=None, exclude_note_ids=()):
+    """
+    Boolean mask matching Note.can_sell on notes without details loaded,
+    excluding the notes in exclude_note_ids
+    """
+    if today is None:
+      today = datetime.date.today()
+    today = today.toordinal()
+    next_payment = self.data['next_payment']
+    mask = ~self.status_in(UNSELLABLE_STATUSES)
+    mask &= next_payment != 0
+    mask &= (next_payment > today) | (next_payment < today - 7)
+    if exclude_note_ids:
+      mask &= ~numpy.in1d(self.data['note_id'], list(exclude_note_ids))
+    return mask
+
+  def sellable_notes(self, exclude_note_ids=()):
+    return self.notes(numpy.flatnonzero(
+        self.can_sell(exclude_note_ids=exclude_note_ids)))
+
+  def due_date_payed_fraction(self, date):
+    """
+    Same as LendingClubBrowser.due_date_payed_fraction using the next
+    payment dates in notes.csv
+    """
+    next_payment = self.data['next_payment']
+    due = ((self.data['next_payment_day'] == date.day) &
+           (next_payment >= date.toordinal()))
+    payed = due & (next_payment > date.toordinal())
+    return int(payed.sum()), int(due.sum())
@@ -0,0 +1,222 @@
+#!/usr/bin/python
+"""replay.py: Record lendingclub.com responses and serve them back locally"""
+__version__ = '3.0'
+__author__ = 'Jason Ansel (jansel@jansel.net)'
+__copyright__ = '(C) 2012-2014. GNU GPL 3.'
+
+import argparse
+import BaseHTTPServer
+import json
+import logging
+import os
+import random
+import SocketServer
+import threading
+import time
+import urllib
+import urlparse
+
+log = logging.getLogger(__name__)
+
+LENDINGCLUB_URL = 'https://www.lendingclub.com'
+
+# query parameters the client fills with random numbers to defeat caches
+VOLATILE_PARAMS = ('r', 'rnd', 'random')
+
+# response headers kept in fixtures
+KEPT_HEADERS = ('Content-Type', 'ETag', 'Last-Modified')
+
+
+def fixture_key(method, url):
+  """
+  'METHOD /path?query' identifying a request, ignoring the host and
+  VOLATILE_PARAMS.  Request bodies are not part of the key, so passwords
+  posted to the login form are never stored.
+  """
+  parts = urlparse.urlsplit(url)
+  query = [(k, v) for k, v in urlparse.parse_qsl(parts.query, True)
+           if k not in VOLATILE_PARAMS]
+  key = '%s %s' % (method, parts.path or '/')
+  if query:
+    key += '?' + urllib.urlencode(sorted(query))
+  return key
+
+
+class Fixtures(object):
+  """
+  Recorded responses in directory, an index.json mapping each fixture_key to
+  the list of responses seen for it in order, plus one file per body
+  """
+
+  def __init__(self, directory):
+    self.directory = directory
+    self.lock = threading.Lock()
+    self.index = dict()
+    try:
+      with open(self.path('index.json')) as fd:
+        self.index = json.load(fd)
+    except IOError:
+      pass
+
+  def path(self, name):
+    return os.path.join(self.directory, name)
+
+  def __len__(self):
+    return sum(len(responses) for responses in self.index.itervalues())
+
+  def add(self, key, status, headers, body):
+    with self.lock:
+      if not os.path.isdir(self.directory):
+        os.makedirs(self.directory)
+      filename = '%05d.body' % len(self)
+      with open(self.path(filename), 'wb') as fd:
+        fd.write(body)
+      self.index.setdefault(key, []).append({'status': status,
+                                             'headers': headers,
+                                             'file': filename})
+      tmp = self.path('index.json.tmp')
+      with open(tmp, 'w') as fd:
+        json.dump(self.index, fd, indent=1, sort_keys=True)
+      os.rename(tmp, self.path('index.json'))
+
+  def get(self, key, n):
+    """
+    (status, headers, body) of the nth response recorded for key, the last
+    one once n runs past the end, or None
+    """
+    responses = self.index.get(key)
+    if not responses:
+      return None
+    response = responses[min(n, len(responses) - 1)]
+    with open(self.path(response['file']), 'rb') as fd:
+      return response['status'], response['headers'], fd.read()
+
+
+class Recorder(object):
+  """
+  Passed to LendingClubBrowser(recorder=...) to save every response it gets
+  as a fixture.  Fixtures contain account data, keep them private.
+  """
+
+  def __init__(self, directory):
+    self.fixtures = Fixtures(directory)
+
+  def record(self, url, data, rsp):
+    if hasattr(url, 'get_full_url'):  # a mechanize.Request
+      method = url.get_method()
+      url = url.get_full_url()
+    else:
+      method = 'POST' if data is not None else 'GET'
+    body = rsp.read()
+    rsp.seek(0)
+    info = rsp.info()
+    headers = dict((name, info[name]) for name in KEPT_HEADERS
+                   if name in info)
+    self.fixtures.add(fixture_key(method, url), getattr(rsp, 'code', 200),
+                      headers, body)
+
+
+class ReplayHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  def do_GET(self):
+    self.server.respond(self, 'GET')
+
+  def do_POST(self):
+    length = int(self.headers.get('Content-Length') or 0)
+    self.rfile.read(length)
+    self.server.respond(self, 'POST')
+
+  def log_message(self, fmt, *args):
+    log.debug('%s %s', self.address_string(), fmt % args)
+
+
+class ReplayServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  """
+  Serves recorded Fixtures in place of lendingclub.com.  Every request is
+  delayed by latency seconds and fails with a 503 with probability
+  error_rate.  Repeated requests get the responses recorded for them in
+  order, and links to lendingclub.com in bodies point back at the server.
+  """
+  daemon_threads = True
+
+  def __init__(self, fixtures, latency=0.0, error_rate=0.0, seed=None,
+               host='127.0.0.1', port=0):
+    BaseHTTPServer.HTTPServer.__init__(self, (host, port), ReplayHandler)
+    self.fixtures = fixtures
+    self.latency = latency
+    self.error_rate = error_rate
+    self.rng = random.Random(seed)
+    self.lock = threading.Lock()
+    self.served = dict()
+    self.thread = None
+
+  @property
+  def base_url(self):
+    return 'http://%s:%d' % self.server_address[:2]
+
+  def respond(self, handler, method):
+    key = fixture_key(method, handler.path)
+    with self.lock:
+      fail = self.rng.random() < self.error_rate
+      n = self.served.get(key, 0)
+      if not fail:
+        self.served[key] = n + 1
+    if self.latency:
+      time.sleep(self.latency)
+    if fail:
+      handler.send_error(503, 'injected failure')
+      return
+    response = self.fixtures.get(key, n)
+    if response is None:
+      log.warning('no fixture for %s', key)
+      handler.send_error(404, 'no fixture')
+      return
+    status, headers, body = response
+    etag = headers.get('ETag')
+    if etag and handler.headers.get('If-None-Match') == etag:
+      handler.send_response(304)
+      handler.end_headers()
+      return
+    body = body.replace(LENDINGCLUB_URL, self.base_url)
+    handler.send_response(status)
+    for name, value in headers.iteritems():
+      handler.send_header(name, value)
+    handler.send_header('Content-Length', str(len(body)))
+    handler.end_headers()
+    handler.wfile.write(body)
+
+  def start(self):
+    """Serve from a background thread, returns base_url"""
+    self.thread = threading.Thread(target=self.serve_forever)
+    self.thread.daemon = True
+    self.thread.start()
+    return self.base_url
+
+  def stop(self):
+    self.shutdown()
+    self.server_close()
+
+
+def main():
+  logging.basicConfig(level=logging.INFO)
+  parser = argparse.ArgumentParser(
+      description='serve fixtures recorded with lcchecker.py --record')
+  parser.add_argument('fixtures')
+  parser.add_argument('--port', type=int, default=8000)
+  parser.add_argument('--latency', type=float, default=0.0,
+                      help='seconds added to every response')
+  parser.add_argument('--error-rate', type=float, default=0.0,
+                      help='fraction of requests answered with a 503')
+  parser.add_argument('--seed', type=int)
+  args = parser.parse_args()
+  server = ReplayServer(Fixtures(args.fixtures), args.latency,
+                        args.error_rate, args.seed, port=args.port)
+  log.info('serving %d responses at %s', len(server.fixtures),
+           server.base_url)
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,124 @@
+#!/usr/bin/python
+"""runstats.py: Per-phase timing spans and counters for an lcchecker run"""
+__version__ = '3.0'
+__author__ = 'Jason Ansel (jansel@jansel.net)'
+__copyright__ = '(C) 2012-2014. GNU GPL 3.'
+
+import collections
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+
+lock = threading.Lock()
+local = threading.local()
+
+started = time.time()
+# (path, start offset, seconds) of every finished span, paths of nested
+# spans are joined with '/'
+spans = []
+counters = collections.Counter()
+
+
+def reset():
+  global started
+  with lock:
+    started = time.time()
+    del spans[:]
+    counters.clear()
+
+
+@contextlib.contextmanager
+def span(name):
+  """Time a phase of the run, spans opened inside it are nested under it"""
+  stack = getattr(local, 'stack', None)
+  if stack is None:
+    stack = local.stack = []
+  stack.append(name)
+  path = '/'.join(stack)
+  t0 = time.time()
+  try:
+    yield
+  finally:
+    elapsed = time.time() - t0
+    stack.pop()
+    with lock:
+      spans.append((path, t0 - started, elapsed))
+
+
+def timed(name):
+  """Decorator running every call of a function in span(name)"""
+  def decorator(fn):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+      with span(name):
+        return fn(*args, **kwargs)
+    return wrapper
+  return decorator
+
+
+def count(name, n=1):
+  with lock:
+    counters[name] += n
+
+
+def add_time(name, seconds):
+  """Add to a counter of seconds, e.g. time spent sleeping"""
+  with lock:
+    counters[name + '_seconds'] += seconds
+
+
+def summary():
+  """[(path, calls, total seconds)] in the order spans were first opened"""
+  with lock:
+    totals = collections.OrderedDict()
+    for path, start, seconds in sorted(spans, key=lambda x: x[1]):
+      calls, total = totals.get(path, (0, 0.0))
+      totals[path] = (calls + 1, total + seconds)
+  return [(path, calls, total) for path, (calls, total) in totals.iteritems()]
+
+
+def format_report():
+  duration = time.time() - started
+  lines = ['', 'Timing (%.1f seconds):' % duration]
+  row_fmt = '  {:48} {:>6} {:>9} {:>6}'
+  lines.append(row_fmt.format('phase', 'calls', 'seconds', '%'))
+  for path, calls, total in summary():
+    depth = path.count('/')
+    lines.append(row_fmt.format('  ' * depth + path.split('/')[-1], calls,
+                                '%.2f' % total,
+                                '%.0f' % (100.0 * total / max(duration, 1e-9))))
+  with lock:
+    items = sorted(counters.items())
+  if items:
+    lines.append('')
+    lines.append('Counters:')
+    for name, value in items:
+      if isinstance(value, float):
+        value = '%.2f' % value
+      lines.append('  {:48} {:>10}'.format(name, value))
+  return '\n'.join(lines) + '\n'
+
+
+def to_dict():
+  with lock:
+    return {'started': started,
+            'duration': time.time() - started,
+            'spans': [{'name': path, 'start': start, 'seconds': seconds}
+                      for path, start, seconds in spans],
+            'counters': dict(counters)}
+
+
+def save(directory, **extra):
+  """Write to_dict() plus extra as directory/<start time>.json"""
+  if not os.path.isdir(directory):
+    os.makedirs(directory)
+  data = to_dict()
+  data.update(extra)
+  filename = os.path.join(directory, time.strftime(
+      '%Y%m%d-%H%M%S.json', time.localtime(started)))
+  with open(filename, 'w') as fd:
+    json.dump(data, fd, indent=1, sort_keys=True)
+  return filename
@@ -0,0 +1,111 @@
+#!/usr/bin/python
+"""test_marketmodel.py: Tests of MarketModel pricing and model install"""
+__version__ = '3.0'
+__author__ = 'Jason Ansel (jansel@jansel.net)'
+__copyright__ = '(C) 2012-2014. GNU GPL 3.'
+
+import numpy
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+from StringIO import StringIO
+
+import benchmark
+import compactforest
+import marketmodel
+
+
+class DipClassifier(object):
+  """
+  Sell probability that is not monotone in price: high up to a 2% markup,
+  low from 2% to 5%, high again up to 10% and low above
+  """
+
+  def predict_proba(self, rows):
+    markup = numpy.asarray(rows)[:, marketmodel.IDX_MARKUP]
+    sell = numpy.where(markup < 2, 0.9,
+                       numpy.where(markup < 5, 0.3,
+                                   numpy.where(markup < 10, 0.9, 0.1)))
+    return numpy.column_stack([1.0 - sell, sell])
+
+
+def note_features(value=100.0):
+  features = [0.0] * len(marketmodel.FEATURE_DECORERS_NAMES)
+  features[marketmodel.IDX_VALUE] = value
+  features[marketmodel.IDX_ASK] = value
+  marketmodel.normalize_feature_vector(features)
+  return features
+
+
+class PricingTest(unittest.TestCase):
+  options = dict(confidence=0.5, min_markup=0.98, max_markup=1.25)
+
+  def setUp(self):
+    self.model = marketmodel.MarketModel(DipClassifier())
+    self.notes = [note_features(value) for value in (25.0, 100.0, 513.27)]
+
+  def grid_prices(self):
+    return self.model.predict_sale_prices(self.notes, search='grid',
+                                          **self.options)
+
+  def test_grid_stops_at_first_dip(self):
+    for features, (price, proba) in zip(self.notes, self.grid_prices()):
+      markup = 100.0 * price / features[marketmodel.IDX_VALUE] - 100.0
+      self.assertLess(markup, 2.0)
+      self.assertGreaterEqual(proba, self.options['confidence'])
+      self.assertEqual(price, self.model.predict_sale_price(
+          list(features), search='grid', **self.options))
+
+  def test_bisect_is_not_exact(self):
+    bisect = self.model.predict_sale_prices(self.notes, search='bisect',
+                                            **self.options)
+    self.assertNotEqual(bisect, self.grid_prices())
+
+  def test_verified_bisect_matches_grid(self):
+    self.assertEqual(self.grid_prices(), self.model.predict_sale_prices(
+        self.notes, search='bisect', verify=True, **self.options))
+    for features, (price, proba) in zip(self.notes, self.grid_prices()):
+      self.assertEqual(price, self.model.predict_sale_price(
+          list(features), search='bisect', verify=True, **self.options))
+
+
+class TrainTest(unittest.TestCase):
+  """train without --sweep installs the model it fits"""
+
+  def setUp(self):
+    self.cwd = os.getcwd()
+    self.argv = sys.argv
+    self.stdout = sys.stdout
+    self.tmpdir = tempfile.mkdtemp()
+    os.chdir(self.tmpdir)
+    os.mkdir('cache')
+    os.mkdir('trading_history')
+    # two days of hourly snapshots from a week ago, all old enough to train on
+    start = int(time.time()) - 7 * 86400
+    for i in xrange(48):
+      benchmark.write_synthetic_snapshot(
+          'trading_history/{}.csv'.format(start + 3600 * i), 200, seed=i % 30,
+          note_ids=2000)
+
+  def tearDown(self):
+    sys.stdout = self.stdout
+    sys.argv = self.argv
+    os.chdir(self.cwd)
+    shutil.rmtree(self.tmpdir)
+    marketmodel.MarketModel._instance = None
+
+  def test_train_installs_compact_model(self):
+    sys.argv = ['marketmodel.py', '--jobs', '1']
+    sys.stdout = StringIO()
+    marketmodel.train()
+    sys.stdout = self.stdout
+    self.assertTrue(marketmodel.compact_model_current())
+    model = marketmodel.MarketModel.instance()
+    self.assertIsInstance(model.clf, compactforest.CompactForest)
+
+
+if __name__ == '__main__':
+  unittest.main()
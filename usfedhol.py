@@ -4,223 +4,83 @@ __version__ = '3.0'
 __author__ = 'Jason Ansel (jansel@jansel.net)'
 __copyright__ = '(C) 2012-2014. GNU GPL 3.'
 
+import bisect
+import dateparse
 import datetime
 import re
 import urllib2
 
-date_names = [
- (datetime.date(1999, 12, 31), 'New Year&rsquo;s Day'),
- (datetime.date(2000, 1, 17), 'Birthday of Martin Luther King, Jr.'),
- (datetime.date(2000, 2, 21), 'Washington&rsquo;s Birthday'),
- (datetime.date(2000, 5, 29), 'Memorial Day'),
- (datetime.date(2000, 7, 4), 'Independence Day'),
- (datetime.date(2000, 9, 4), 'Labor Day'),
- (datetime.date(2000, 10, 9), 'Columbus Day'),
- (datetime.date(2000, 11, 10), 'Veterans Day'),
- (datetime.date(2000, 11, 23), 'Thanksgiving Day'),
- (datetime.date(2000, 12, 25), 'Christmas Day'),
- (datetime.date(2001, 1, 1), 'New Year&rsquo;s Day'),
- (datetime.date(2001, 1, 15), 'Birthday of Martin Luther King, Jr.'),
- (datetime.date(2001, 2, 19), 'Washington&rsquo;s Birthday'),
- (datetime.date(2001, 5, 28), 'Memorial Day'),
- (datetime.date(2001, 7, 4), 'Independence Day'),
- (datetime.date(2001, 9, 3), 'Labor Day'),
- (datetime.date(2001, 10, 8), 'Columbus Day'),
- (datetime.date(2001, 11, 12), 'Veterans Day'),
- (datetime.date(2001, 11, 22), 'Thanksgiving Day'),
- (datetime.date(2001, 12, 25), 'Christmas Day'),
- (datetime.date(2002, 1, 1), 'New Year&rsquo;s Day'),
- (datetime.date(2002, 1, 21), 'Birthday of Martin Luther King, Jr.'),
- (datetime.date(2002, 2, 18), 'Washington&rsquo;s Birthday'),
- (datetime.date(2002, 5, 27), 'Memorial Day'),
- (datetime.date(2002, 7, 4), 'Independence Day'),
- (datetime.date(2002, 9, 2), 'Labor Day'),
- (datetime.date(2002, 10, 14), 'Columbus Day'),
- (datetime.date(2002, 11, 11), 'Veterans Day'),
- (datetime.date(2002, 11, 28), 'Thanksgiving Day'),
- (datetime.date(2002, 12, 25), 'Christmas Day'),
- (datetime.date(2003, 1, 1), 'New Year&rsquo;s Day'),
- (datetime.date(2003, 1, 20), 'Birthday of Martin Luther King, Jr.'),
- (datetime.date(2003, 2, 17), 'Washington&rsquo;s Birthday'),
- (datetime.date(2003, 5, 26), 'Memorial Day'),
- (datetime.date(2003, 7, 4), 'Independence Day'),
- (datetime.date(2003, 9, 1), 'Labor Day'),
- (datetime.date(2003, 10, 13), 'Columbus Day'),
- (datetime.date(2003, 11, 11), 'Veterans Day'),
- (datetime.date(2003, 11, 27), 'Thanksgiving Day'),
- (datetime.date(2003, 12, 25), 'Christmas Day'),
- (datetime.date(2004, 1, 1), "New Year's Day"),
- (datetime.date(2004, 1, 19), 'Birthday of Martin Luther King, Jr.'),
- (datetime.date(2004, 2, 16), "Washington's Birthday"),
- (datetime.date(2004, 5, 31), 'Memorial Day'),
- (datetime.date(2004, 7, 5), 'Independence Day'),
- (datetime.date(2004, 9, 6), 'Labor Day'),
- (datetime.date(2004, 10, 11), 'Columbus Day'),
- (datetime.date(2004, 11, 11), 'Veterans Day'),
- (datetime.date(2004, 11, 25), 'Thanksgiving Day'),
- (datetime.date(2004, 12, 24), 'Christmas Day'),
- (datetime.date(2004, 12, 31), 'New Year&rsquo;s Day'),
- (datetime.date(2005, 1, 17), 'Birthday of Martin Luther King, Jr.'),
- (datetime.date(2005, 2, 21), 'Washington&rsquo;s Birthday'),
- (datetime.date(2005, 5, 30), 'Memorial Day'),
- (datetime.date(2005, 7, 4), 'Independence Day'),
- (datetime.date(2005, 9, 5), 'Labor Day'),
- (datetime.date(2005, 10, 10), 'Columbus Day'),
- (datetime.date(2005, 11, 11), 'Veterans Day'),
- (datetime.date(2005, 11, 24), 'Thanksgiving Day'),
- (datetime.date(2005, 12, 26), 'Christmas Day'),
- (datetime.date(2006, 1, 2), 'New Year&rsquo;s Day'),
- (datetime.date(2006, 1, 16), 'Birthday of Martin Luther King, Jr.'),
- (datetime.date(2006, 2, 20), 'Washington&rsquo;s Birthday'),
- (datetime.date(2006, 5, 29), 'Memorial Day'),
- (datetime.date(2006, 7, 4), 'Independence Day'),
- (datetime.date(2006, 9, 4), 'Labor Day'),
- (datetime.date(2006, 10, 9), 'Columbus Day'),
- (datetime.date(2006, 11, 10), 'Veterans Day'),
- (datetime.date(2006, 11, 23), 'Thanksgiving Day'),
- (datetime.date(2006, 12, 25), 'Christmas Day'),
- (datetime.date(2007, 1, 1), 'New Year&rsquo;s Day'),
- (datetime.date(2007, 1, 15), 'Birthday of Martin Luther King, Jr.'),
- (datetime.date(2007, 2, 19), 'Washington&rsquo;s Birthday'),
- (datetime.date(2007, 5, 28), 'Memorial Day'),
- (datetime.date(2007, 7, 4), 'Independence Day'),
- (datetime.date(2007, 9, 3), 'Labor Day'),
- (datetime.date(2007, 10, 8), 'Columbus Day'),
- (datetime.date(2007, 11, 12), 'Veterans Day'),
- (datetime.date(2007, 11, 22), 'Thanksgiving Day'),
- (datetime.date(2007, 12, 25), 'Christmas Day'),
- (datetime.date(2008, 1, 1), 'New Year&rsquo;s Day'),
- (datetime.date(2008, 1, 21), 'Birthday of Martin Luther King, Jr.'),
- (datetime.date(2008, 2, 18), 'Washington&rsquo;s Birthday'),
- (datetime.date(2008, 5, 26), 'Memorial Day'),
- (datetime.date(2008, 7, 4), 'Independence Day'),
- (datetime.date(2008, 9, 1), 'Labor Day'),
- (datetime.date(2008, 10, 13), 'Columbus Day'),
- (datetime.date(2008, 11, 11), 'Veterans Day'),
- (datetime.date(2008, 11, 27), 'Thanksgiving Day'),
- (datetime.date(2008, 12, 25), 'Christmas Day'),
- (datetime.date(2009, 1, 1), 'New Year&rsquo;s Day'),
- (datetime.date(2009, 1, 19), 'Birthday of Martin Luther King, Jr.'),
- (datetime.date(2009, 2, 16), 'Washington&rsquo;s Birthday'),
- (datetime.date(2009, 5, 25), 'Memorial Day'),
- (datetime.date(2009, 7, 3), 'Independence Day'),
- (datetime.date(2009, 9, 7), 'Labor Day'),
- (datetime.date(2009, 10, 12), 'Columbus Day'),
- (datetime.date(2009, 11, 11), 'Veterans Day'),
- (datetime.date(2009, 11, 26), 'Thanksgiving Day'),
- (datetime.date(2009, 12, 25), 'Christmas Day'),
- (datetime.date(2010, 1, 1), 'New Year&rsquo;s Day'),
- (datetime.date(2010, 1, 18), 'Birthday of Martin Luther King, Jr.'),
- (datetime.date(2010, 2, 15), 'Washington&rsquo;s Birthday'),
- (datetime.date(2010, 5, 31), 'Memorial Day'),
- (datetime.date(2010, 7, 5), 'Independence Day'),
- (datetime.date(2010, 9, 6), 'Labor Day'),
- (datetime.date(2010, 10, 11), 'Columbus Day'),
- (datetime.date(2010, 11, 11), 'Veterans Day'),
- (datetime.date(2010, 11, 25), 'Thanksgiving Day'),
- (datetime.date(2010, 12, 24), 'Christmas Day'),
- (datetime.date(2010, 12, 31), 'New Year&rsquo;s Day'),
- (datetime.date(2011, 1, 17), 'Birthday of Martin Luther King, Jr.'),
- (datetime.date(2011, 2, 21), 'Washington&rsquo;s Birthday'),
- (datetime.date(2011, 5, 30), 'Memorial Day'),
- (datetime.date(2011, 7, 4), 'Independence Day'),
- (datetime.date(2011, 9, 5), 'Labor Day'),
- (datetime.date(2011, 10, 10), 'Columbus Day'),
- (datetime.date(2011, 11, 11), 'Veterans Day'),
- (datetime.date(2011, 11, 24), 'Thanksgiving Day'),
- (datetime.date(2011, 12, 26), 'Christmas Day'),
- (datetime.date(2012, 1, 2), "New Year's Day"),
- (datetime.date(2012, 1, 16), 'Birthday of Martin Luther King, Jr.'),
- (datetime.date(2012, 2, 20), "Washington's Birthday"),
- (datetime.date(2012, 5, 28), 'Memorial Day'),
- (datetime.date(2012, 7, 4), 'Independence Day'),
- (datetime.date(2012, 9, 3), 'Labor Day'),
- (datetime.date(2012, 10, 8), 'Columbus Day'),
- (datetime.date(2012, 11, 12), 'Veterans Day'),
- (datetime.date(2012, 11, 22), 'Thanksgiving Day'),
- (datetime.date(2012, 12, 25), 'Christmas Day'),
- (datetime.date(2013, 1, 1), 'New Year&rsquo;s Day'),
- (datetime.date(2013, 1, 21), 'Birthday of Martin Luther King, Jr.'),
- (datetime.date(2013, 2, 18), 'Washington&rsquo;s Birthday'),
- (datetime.date(2013, 5, 27), 'Memorial Day'),
- (datetime.date(2013, 7, 4), 'Independence Day'),
- (datetime.date(2013, 9, 2), 'Labor Day'),
- (datetime.date(2013, 10, 14), 'Columbus Day'),
- (datetime.date(2013, 11, 11), 'Veterans Day'),
- (datetime.date(2013, 11, 28), 'Thanksgiving Day'),
- (datetime.date(2013, 12, 25), 'Christmas Day'),
- (datetime.date(2014, 1, 1), 'New Year&rsquo;s Day'),
- (datetime.date(2014, 1, 20), 'Birthday of Martin Luther King, Jr.'),
- (datetime.date(2014, 2, 17), 'Washington&rsquo;s Birthday'),
- (datetime.date(2014, 5, 26), 'Memorial Day'),
- (datetime.date(2014, 7, 4), 'Independence Day'),
- (datetime.date(2014, 9, 1), 'Labor Day'),
- (datetime.date(2014, 10, 13), 'Columbus Day'),
- (datetime.date(2014, 11, 11), 'Veterans Day'),
- (datetime.date(2014, 11, 27), 'Thanksgiving Day'),
- (datetime.date(2014, 12, 25), 'Christmas Day'),
- (datetime.date(2015, 1, 1), 'New Year&rsquo;s Day'),
- (datetime.date(2015, 1, 19), 'Birthday of Martin Luther King, Jr.'),
- (datetime.date(2015, 2, 16), 'Washington&rsquo;s Birthday'),
- (datetime.date(2015, 5, 25), 'Memorial Day'),
- (datetime.date(2015, 7, 3), 'Independence Day'),
- (datetime.date(2015, 9, 7), 'Labor Day'),
- (datetime.date(2015, 10, 12), 'Columbus Day'),
- (datetime.date(2015, 11, 11), 'Veterans Day'),
- (datetime.date(2015, 11, 26), 'Thanksgiving Day'),
- (datetime.date(2015, 12, 25), 'Christmas Day'),
- (datetime.date(2016, 1, 1), 'New Year&rsquo;s Day'),
- (datetime.date(2016, 1, 18), 'Birthday of Martin Luther King, Jr.'),
- (datetime.date(2016, 2, 15), 'Washington&rsquo;s Birthday'),
- (datetime.date(2016, 5, 30), 'Memorial Day'),
- (datetime.date(2016, 7, 4), 'Independence Day'),
- (datetime.date(2016, 9, 5), 'Labor Day'),
- (datetime.date(2016, 10, 10), 'Columbus Day'),
- (datetime.date(2016, 11, 11), 'Veterans Day'),
- (datetime.date(2016, 11, 24), 'Thanksgiving Day'),
- (datetime.date(2016, 12, 26), 'Christmas Day'),
- (datetime.date(2017, 1, 2), 'New Year&rsquo;s Day'),
- (datetime.date(2017, 1, 16), 'Birthday of Martin Luther King, Jr.'),
- (datetime.date(2017, 2, 20), 'Washington&rsquo;s Birthday'),
- (datetime.date(2017, 5, 29), 'Memorial Day'),
- (datetime.date(2017, 7, 4), 'Independence Day'),
- (datetime.date(2017, 9, 4), 'Labor Day'),
- (datetime.date(2017, 10, 9), 'Columbus Day'),
- (datetime.date(2017, 11, 10), 'Veterans Day'),
- (datetime.date(2017, 11, 23), 'Thanksgiving Day'),
- (datetime.date(2017, 12, 25), 'Christmas Day'),
- (datetime.date(2018, 1, 1), 'New Year&rsquo;s Day'),
- (datetime.date(2018, 1, 15), 'Birthday of Martin Luther King, Jr.'),
- (datetime.date(2018, 2, 19), 'Washington&rsquo;s Birthday'),
- (datetime.date(2018, 5, 28), 'Memorial Day'),
- (datetime.date(2018, 7, 4), 'Independence Day'),
- (datetime.date(2018, 9, 3), 'Labor Day'),
- (datetime.date(2018, 10, 8), 'Columbus Day'),
- (datetime.date(2018, 11, 12), 'Veterans Day'),
- (datetime.date(2018, 11, 22), 'Thanksgiving Day'),
- (datetime.date(2018, 12, 25), 'Christmas Day'),
- (datetime.date(2019, 1, 1), 'New Year&rsquo;s Day'),
- (datetime.date(2019, 1, 21), 'Birthday of Martin Luther King, Jr.'),
- (datetime.date(2019, 2, 18), 'Washington&rsquo;s Birthday'),
- (datetime.date(2019, 5, 27), 'Memorial Day'),
- (datetime.date(2019, 7, 4), 'Independence Day'),
- (datetime.date(2019, 9, 2), 'Labor Day'),
- (datetime.date(2019, 10, 14), 'Columbus Day'),
- (datetime.date(2019, 11, 11), 'Veterans Day'),
- (datetime.date(2019, 11, 28), 'Thanksgiving Day'),
- (datetime.date(2019, 12, 25), 'Christmas Day'),
- (datetime.date(2020, 1, 1), 'New Year&rsquo;s Day'),
- (datetime.date(2020, 1, 20), 'Birthday of Martin Luther King, Jr.'),
- (datetime.date(2020, 2, 17), 'Washington&rsquo;s Birthday'),
- (datetime.date(2020, 5, 25), 'Memorial Day'),
- (datetime.date(2020, 7, 3), 'Independence Day'),
- (datetime.date(2020, 9, 7), 'Labor Day'),
- (datetime.date(2020, 10, 12), 'Columbus Day'),
- (datetime.date(2020, 11, 11), 'Veterans Day'),
- (datetime.date(2020, 11, 26), 'Thanksgiving Day'),
- (datetime.date(2020, 12, 25), 'Christmas Day')]
-
-dates = sorted(map(lambda x: x[0], date_names))
+# month, day of fixed date holidays, observed on the Friday before when they
+# fall on a Saturday and the Monday after when they fall on a Sunday
+FIXED_HOLIDAYS = [
+  (1, 1, "New Year's Day", None),
+  (6, 19, 'Juneteenth National Independence Day', 2021),
+  (7, 4, 'Independence Day', None),
+  (11, 11, 'Veterans Day', None),
+  (12, 25, 'Christmas Day', None)]
+
+# month, weekday (0=monday), nth occurrence (-1=last) of holidays falling on
+# a given weekday
+WEEKDAY_HOLIDAYS = [
+  (1, 0, 3, 'Birthday of Martin Luther King, Jr.', 1986),
+  (2, 0, 3, "Washington's Birthday", None),
+  (5, 0, -1, 'Memorial Day', None),
+  (9, 0, 1, 'Labor Day', None),
+  (10, 0, 2, 'Columbus Day', None),
+  (11, 3, 4, 'Thanksgiving Day', None)]
+
+# year -> sorted ordinals of the holidays observed in that year
+cache = dict()
+
+
+def observed(d):
+  if d.weekday() == 5:
+    return d - datetime.timedelta(1)
+  if d.weekday() == 6:
+    return d + datetime.timedelta(1)
+  return d
+
+
+def nth_weekday(year, month, weekday, n):
+  """The nth weekday of a month, n=-1 for the last one"""
+  if n > 0:
+    first = datetime.date(year, month, 1)
+    return first + datetime.timedelta((weekday - first.weekday()) % 7 +
+                                      7 * (n - 1))
+  last = (datetime.date(year + month // 12, month % 12 + 1, 1) -
+          datetime.timedelta(1))
+  return last - datetime.timedelta((last.weekday() - weekday) % 7 +
+                                   7 * (-1 - n))
+
+
+def holiday_rules(year):
+  """[(observed date, name)] of the holidays of year by 5 U.S.C. 6103"""
+  rv = list()
+  for month, day, name, since in FIXED_HOLIDAYS:
+    if since is None or year >= since:
+      rv.append((observed(datetime.date(year, month, day)), name))
+  for month, weekday, n, name, since in WEEKDAY_HOLIDAYS:
+    if since is None or year >= since:
+      rv.append((nth_weekday(year, month, weekday, n), name))
+  return rv
+
+
+def holidays(year):
+  """
+  Sorted [(date, name)] of the holidays observed during the calendar year,
+  a New Year's Day falling on a Saturday is observed on December 31st of
+  the year before
+  """
+  return sorted((d, name)
+                for d, name in holiday_rules(year) + holiday_rules(year + 1)
+                if d.year == year)
+
+
+def holiday_ordinals(year):
+  rv = cache.get(year)
+  if rv is None:
+    rv = cache[year] = [d.toordinal() for d, name in holidays(year)]
+  return rv
 
 
 def extract_row(tr, tag='td'):
@@ -232,12 +92,7 @@ def extract_row(tr, tag='td'):
   return rv
 
 
-def parsedate(s):
-  import parsedatetime.parsedatetime as pdt
-  p = pdt.Calendar()
-  if s == '--':
-    return None
-  return datetime.date(*p.parse(s)[0][0:3])
+parsedate = dateparse.parsedate
 
 
 def fetch_holidays(years=range(2000, 2021)):
@@ -268,18 +123,55 @@ def fetch_holidays(years=range(2000, 2021)):
 
 
 def is_holiday(d):
-  assert dates[0] <= d and d <= dates[-1]
-  return d in dates
+  ordinals = holiday_ordinals(d.year)
+  i = bisect.bisect_left(ordinals, d.toordinal())
+  return i < len(ordinals) and ordinals[i] == d.toordinal()
 
 
 def contains_holiday(a, b):
-  assert dates[0] <= a and a <= dates[-1]
-  assert dates[0] <= b and b <= dates[-1]
-  if a <= b:
-    return 0 < len(filter(lambda x: a <= x and x <= b, dates))
-  else:
-    return 0 < len(filter(lambda x: a >= x and x >= b, dates))
+  """True if a holiday falls between dates a and b inclusive, in any order"""
+  a, b = min(a, b), max(a, b)
+  for year in xrange(a.year, b.year + 1):
+    ordinals = holiday_ordinals(year)
+    if (bisect.bisect_right(ordinals, b.toordinal()) >
+            bisect.bisect_left(ordinals, a.toordinal())):
+      return True
+  return False
+
+
+def as_ordinals(values):
+  """Array of date ordinals given a sequence of dates or ordinals"""
+  import numpy
+  if not hasattr(values, 'dtype'):
+    values = list(values)
+  if len(values) and isinstance(values[0], datetime.date):
+    values = [d.toordinal() for d in values]
+  return numpy.asarray(values, dtype=numpy.int64)
+
+
+def count_holidays(starts, ends):
+  """
+  Vectorized contains_holiday, an array with the number of holidays in
+  each range [starts[i], ends[i]] (in any order) given sequences of dates or
+  arrays of date ordinals
+  """
+  import numpy
+  starts = as_ordinals(starts)
+  ends = as_ordinals(ends)
+  starts, ends = numpy.minimum(starts, ends), numpy.maximum(starts, ends)
+  if not len(starts):
+    return numpy.zeros(0, dtype=int)
+  first = datetime.date.fromordinal(int(starts.min())).year
+  last = datetime.date.fromordinal(int(ends.max())).year
+  ordinals = numpy.array(sum((holiday_ordinals(year)
+                              for year in xrange(first, last + 1)), []))
+  return (numpy.searchsorted(ordinals, ends, 'right') -
+          numpy.searchsorted(ordinals, starts, 'left'))
+
 
 if __name__ == '__main__':
+  import sys
   from pprint import pprint
-  pprint(fetch_holidays())
+  years = map(int, sys.argv[1:]) or [datetime.date.today().year]
+  for year in years:
+    pprint(holidays(year))